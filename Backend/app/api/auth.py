@@ -1,19 +1,18 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Response, Request
+from fastapi.concurrency import run_in_threadpool
 import httpx
 from sqlalchemy.orm import Session
 from datetime import timedelta
 
-from fastapi.security import OAuth2PasswordBearer
-from jose import JWTError, jwt
+from jose import JWTError
 
 from app.services import auth as auth_service
-from app.models.user import UserCreate, UserLogin, UserOut
+from app.models.user import User, UserCreate, UserLogin, UserOut
+from app.services.auth import get_current_user
 from app.database import get_db
 from app.core.config import (
     ACCESS_TOKEN_EXPIRE_MINUTES,
     REFRESH_TOKEN_EXPIRE_DAYS,
-    SECRET_KEY,
-    ALGORITHM,
     COOKIE_DOMAIN,
     COOKIE_SECURE,
     COOKIE_SAMESITE,
@@ -23,7 +22,9 @@ from app.core.config import (
 
 router = APIRouter()
 
-def verify_turnstile(token: str | None, request: Request) -> None:
+SITEVERIFY_URL = "https://challenges.cloudflare.com/turnstile/v0/siteverify"
+
+async def verify_turnstile(token: str | None, request: Request) -> None:
     if not TURNSTILE_ENABLED:
         return
     if not TURNSTILE_SECRET_KEY:
@@ -36,12 +37,9 @@ def verify_turnstile(token: str | None, request: Request) -> None:
         "response": token,
         "remoteip": request.client.host if request.client else None,
     }
+    client: httpx.AsyncClient = request.app.state.http
     try:
-        resp = httpx.post(
-            "https://challenges.cloudflare.com/turnstile/v0/siteverify",
-            data=payload,
-            timeout=10.0,
-        )
+        resp = await client.post(SITEVERIFY_URL, data=payload)
         resp.raise_for_status()
         data = resp.json()
     except httpx.HTTPError as exc:
@@ -51,24 +49,26 @@ def verify_turnstile(token: str | None, request: Request) -> None:
         raise HTTPException(status_code=400, detail="Bot verification failed")
 
 @router.post("/signup", response_model=UserOut)
-def signup(user_data: UserCreate, request: Request, db: Session = Depends(get_db)):
-    verify_turnstile(user_data.turnstile_token, request)
-    existing = auth_service.get_user_by_email(db, user_data.email)
+async def signup(user_data: UserCreate, request: Request, db: Session = Depends(get_db)):
+    await verify_turnstile(user_data.turnstile_token, request)
+    existing = await run_in_threadpool(auth_service.get_user_by_email, db, user_data.email)
     if existing:
         raise HTTPException(status_code=400, detail="Email already registered")
 
-    hashed_pw = auth_service.get_password_hash(user_data.password)
+    # argon2 hashing and the DB round-trips are blocking; keep them off the event loop
+    hashed_pw = await run_in_threadpool(auth_service.get_password_hash, user_data.password)
     new_user = auth_service.models.User(email=user_data.email, hashed_pw=hashed_pw)
+    auth_service.forget_user_email(user_data.email)
 
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await run_in_threadpool(db.commit)
+    await run_in_threadpool(db.refresh, new_user)
 
     return new_user
 
 
 @router.post("/login", response_model=dict)
-def login(
+async def login(
     user_data: UserLogin,
     response: Response,
     request: Request,
@@ -79,8 +79,10 @@ def login(
       1) Return a short‐lived access token in the JSON response body.
       2) Set a long‐lived refresh token as an httpOnly cookie.
     """
-    verify_turnstile(user_data.turnstile_token, request)
-    user = auth_service.authenticate_user(db, user_data.email, user_data.password)
+    await verify_turnstile(user_data.turnstile_token, request)
+    user = await run_in_threadpool(
+        auth_service.authenticate_user, db, user_data.email, user_data.password
+    )
     if not user:
         raise HTTPException(status_code=401, detail="Invalid credentials")
 
@@ -111,9 +113,6 @@ def login(
     return {"access_token": access_token, "token_type": "bearer"}
 
 
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
-
-
 @router.post("/refresh", response_model=dict)
 def refresh_token(
     request: Request,
@@ -133,7 +132,7 @@ def refresh_token(
 
     # 1) Decode/verify the refresh token
     try:
-        payload = jwt.decode(refresh_token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = auth_service.decode_token_cached(refresh_token)
         email: str = payload.get("sub")
         if email is None:
             raise JWTError("No subject in token")
@@ -173,30 +172,9 @@ def refresh_token(
 
 
 @router.get("/me", response_model=UserOut)
-def read_users_me(
-    token: str = Depends(oauth2_scheme),
-    db: Session = Depends(get_db),
-):
+def read_users_me(current_user: User = Depends(get_current_user)):
     """
     Standard “get me” endpoint. Reads the Authorization: Bearer <access_token>
     header, decodes it, and returns the current user.
     """
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
-
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
-            raise credentials_exception
-    except JWTError:
-        raise credentials_exception
-
-    user = auth_service.get_user_by_email(db, email)
-    if user is None:
-        raise credentials_exception
-
-    return user
+    return current_user
@@ -1,18 +1,28 @@
 # app/api/routes.py
 
+import asyncio
+import codecs
+import glob
 import os
-import json
+import string
 import time
 import pickle
+import threading
+import uuid
+from contextlib import contextmanager, suppress
+from functools import lru_cache
 from typing import List
 
-from fastapi import APIRouter, HTTPException, UploadFile, File, Depends
-from fastapi.responses import HTMLResponse, JSONResponse
+import anyio
+import orjson
+from fastapi import APIRouter, HTTPException, UploadFile, File, Depends, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import HTMLResponse, StreamingResponse
 from pydantic import BaseModel
 
 from app.services.auth import get_current_user  # our JWT dependency
 from app.models.user import User                 # SQLAlchemy User model
-from app.services.llm_providers import build_provider
+from app.services.llm_providers import LLMProvider, ModelSpec, build_provider
 from app.services.model_registry import (
     list_available_models,
     resolve_default_model,
@@ -23,10 +33,10 @@ CONTEXT_ENABLED = os.getenv("CONTEXT_ENABLED", "false").lower() == "true"
 
 if CONTEXT_ENABLED:
     from app.services.memory import MemoryStore
-    from app.services.vector_store import get_chroma_client, init_collection
+    from app.services.vector_store import get_chroma_client
     from app.services.rag import (
-        chunk_text,
-        embed_chunks,
+        StreamingChunker,
+        aembed_chunks,
         embed_query,
         build_rag_prompt,
     )
@@ -38,14 +48,15 @@ else:
         raise RuntimeError("Context features are disabled")
 
     get_chroma_client = _disabled
-    init_collection = _disabled
-    chunk_text = _disabled
-    embed_chunks = _disabled
+    StreamingChunker = _disabled
+    aembed_chunks = _disabled
     embed_query = _disabled
     build_rag_prompt = _disabled
 
 router = APIRouter()
 _memory_stores: dict[int, MemoryStore] = {}
+_memory_locks: dict[int, threading.RLock] = {}
+_memory_locks_guard = threading.Lock()
 
 # ──────────────────────────────────────────────────────────────────────────────
 # 1) Per‐user chat_history persistence
@@ -54,67 +65,245 @@ _memory_stores: dict[int, MemoryStore] = {}
 CHAT_HISTORY_DIR = "chat_history"
 os.makedirs(CHAT_HISTORY_DIR, exist_ok=True)
 
+@contextmanager
+def _atomic_open(path: str):
+    """
+    Open a temp file next to `path` for binary writing and atomically
+    replace `path` with it on success, so a crash mid-write never leaves a
+    truncated file behind.
+    """
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        with suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
+# Deletes every ASCII character that isn't allowed in a session id; non-ASCII
+# is dropped by the encode step before translating.
+_SESSION_ID_ALLOWED = frozenset(string.ascii_letters + string.digits + "-_")
+_SESSION_ID_STRIP = str.maketrans(
+    "", "", "".join(chr(c) for c in range(128) if chr(c) not in _SESSION_ID_ALLOWED)
+)
+
+@lru_cache(maxsize=1024)
 def _normalize_session_id(session_id: str | None) -> str:
     if not session_id:
         return "default"
-    filtered = "".join(ch for ch in session_id if ch.isalnum() or ch in {"-", "_"})
+    filtered = session_id.encode("ascii", "ignore").decode("ascii").translate(_SESSION_ID_STRIP)
     return filtered[:64] or "default"
 
+# User ids whose chat_history/<id>/ directory is known to exist in this process
+_user_dirs_created: set[int] = set()
+
+def _user_history_dir(user_id: int) -> str:
+    user_dir = os.path.join(CHAT_HISTORY_DIR, str(user_id))
+    if user_id not in _user_dirs_created:
+        os.makedirs(user_dir, exist_ok=True)
+        _user_dirs_created.add(user_id)
+    return user_dir
+
 def user_history_file(user_id: int, session_id: str) -> str:
     """
-    Return the path for this user’s chat-history file for a session.
+    Return the path for this user’s append-only (JSONL) message log for a session.
     """
     session_id = _normalize_session_id(session_id)
-    user_dir = os.path.join(CHAT_HISTORY_DIR, str(user_id))
-    os.makedirs(user_dir, exist_ok=True)
-    return os.path.join(user_dir, f"{session_id}.json")
+    return os.path.join(_user_history_dir(user_id), f"{session_id}.jsonl")
+
+def user_session_meta_file(user_id: int, session_id: str) -> str:
+    """
+    Return the path for the session metadata sidecar (selected provider/model).
+    """
+    session_id = _normalize_session_id(session_id)
+    return os.path.join(_user_history_dir(user_id), f"{session_id}.meta.json")
+
+def _legacy_session_file(user_id: int, session_id: str) -> str:
+    session_id = _normalize_session_id(session_id)
+    return os.path.join(_user_history_dir(user_id), f"{session_id}.json")
 
 def _legacy_history_file(user_id: int) -> str:
     return os.path.join(CHAT_HISTORY_DIR, f"{user_id}.json")
 
-def load_chat_history(user_id: int, session_id: str) -> tuple[List[dict], dict]:
+def _read_legacy_history(user_id: int, session_id: str) -> tuple[List[dict], dict] | None:
     """
-    Load chat history from disk for this user/session.
-    Returns (messages, session_meta).
+    Read a pre-JSONL history file ({session}.json, or {user}.json for the
+    default session). Returns None if there is nothing usable.
     """
-    path = user_history_file(user_id, session_id)
-    paths_to_try = [path]
+    paths_to_try = [_legacy_session_file(user_id, session_id)]
     if _normalize_session_id(session_id) == "default":
         paths_to_try.append(_legacy_history_file(user_id))
 
     for candidate in paths_to_try:
         if os.path.exists(candidate):
             try:
-                with open(candidate, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                    if isinstance(data, list):
-                        return data, {}
-                    if isinstance(data, dict):
-                        messages = data.get("messages", [])
-                        session_meta = data.get("session", {})
-                        if isinstance(messages, list) and isinstance(session_meta, dict):
-                            return messages, session_meta
+                with open(candidate, "rb") as f:
+                    data = orjson.loads(f.read())
+                if isinstance(data, list):
+                    return data, {}
+                if isinstance(data, dict):
+                    messages = data.get("messages", [])
+                    session_meta = data.get("session", {})
+                    if isinstance(messages, list) and isinstance(session_meta, dict):
+                        return messages, session_meta
             except Exception:
                 pass
-    return [], {}
+    return None
+
+def _migrate_legacy_history(user_id: int, session_id: str) -> tuple[List[dict], dict]:
+    """
+    One-time conversion of a legacy history file to JSONL + meta sidecar.
+    """
+    legacy = _read_legacy_history(user_id, session_id)
+    if legacy is None:
+        return [], {}
+    messages, session_meta = legacy
+    try:
+        with _atomic_open(user_history_file(user_id, session_id)) as f:
+            f.write(b"".join(orjson.dumps(m, option=orjson.OPT_APPEND_NEWLINE) for m in messages))
+        persist_session_meta(user_id, session_id, session_meta)
+    except Exception as e:
+        print(f"Error migrating chat history for user {user_id}: {e}")
+    return messages, session_meta
+
+def load_session_meta(user_id: int, session_id: str) -> dict:
+    path = user_session_meta_file(user_id, session_id)
+    try:
+        with open(path, "rb") as f:
+            data = orjson.loads(f.read())
+        return data if isinstance(data, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+def load_chat_history(user_id: int, session_id: str) -> tuple[List[dict], dict]:
+    """
+    Load chat history from disk for this user/session.
+    Returns (messages, session_meta).
+    """
+    path = user_history_file(user_id, session_id)
+    if not os.path.exists(path):
+        return _migrate_legacy_history(user_id, session_id)
+
+    messages: List[dict] = []
+    try:
+        with open(path, "rb") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    messages.append(orjson.loads(line))
+                except orjson.JSONDecodeError:
+                    # Skip a partially written trailing line
+                    continue
+    except OSError:
+        return [], {}
+    return messages, load_session_meta(user_id, session_id)
+
+_TAIL_BLOCK_SIZE = 64 * 1024
+
+def _read_jsonl_tail(path: str, limit: int) -> List[dict]:
+    """
+    The last `limit` parseable records of a JSONL file, read backwards in
+    _TAIL_BLOCK_SIZE blocks so the cost doesn't grow with the file.
+    """
+    newest_first: List[dict] = []
+    with open(path, "rb") as f:
+        pos = f.seek(0, os.SEEK_END)
+        carry = b""  # partial line at the start of the previous block
+        while pos > 0 and len(newest_first) < limit:
+            size = min(_TAIL_BLOCK_SIZE, pos)
+            pos -= size
+            f.seek(pos)
+            lines = (f.read(size) + carry).split(b"\n")
+            carry = lines.pop(0) if pos > 0 else b""
+            for line in reversed(lines):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    newest_first.append(orjson.loads(line))
+                except orjson.JSONDecodeError:
+                    # Skip a partially written trailing line
+                    continue
+                if len(newest_first) == limit:
+                    break
+    newest_first.reverse()
+    return newest_first
+
+def load_recent_chat_history(user_id: int, session_id: str, limit: int) -> tuple[List[dict], dict]:
+    """
+    Like load_chat_history, but only the last `limit` messages, read from the
+    end of the log (the full O(N) load is left to /api/history).
+    """
+    path = user_history_file(user_id, session_id)
+    if not os.path.exists(path):
+        messages, session_meta = _migrate_legacy_history(user_id, session_id)
+        return messages[-limit:], session_meta
+    try:
+        messages = _read_jsonl_tail(path, limit)
+    except OSError:
+        return [], {}
+    return messages, load_session_meta(user_id, session_id)
 
-def persist_chat_history(user_id: int, session_id: str, chat_history: List[dict], session_meta: dict):
+def append_message(user_id: int, session_id: str, message: dict):
     """
-    Write this user’s chat_history and session metadata to disk.
+    Append a single message to this user’s session log. O(1) in history length.
     """
     path = user_history_file(user_id, session_id)
-    payload = {"messages": chat_history, "session": session_meta}
     try:
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(payload, f, ensure_ascii=False, indent=2)
+        with open(path, "ab") as f:
+            f.write(orjson.dumps(message, option=orjson.OPT_APPEND_NEWLINE))
     except Exception as e:
         print(f"Error writing chat history for user {user_id}: {e}")
 
+def persist_session_meta(user_id: int, session_id: str, session_meta: dict):
+    """
+    Write this session’s metadata sidecar to disk.
+    """
+    path = user_session_meta_file(user_id, session_id)
+    try:
+        with _atomic_open(path) as f:
+            f.write(orjson.dumps(session_meta))
+    except Exception as e:
+        print(f"Error writing session metadata for user {user_id}: {e}")
+
 
 # ──────────────────────────────────────────────────────────────────────────────
 # 2) RAG endpoints (per‐user Chroma collections)
 # ──────────────────────────────────────────────────────────────────────────────
 
+def get_collection(app, user_id: int):
+    """
+    Return this user's Chroma collection, resolving it through the shared
+    client on app.state only the first time and caching it there afterwards.
+    """
+    cache = app.state.collection_cache
+    key = f"documents_{user_id}"
+    collection = cache.get(key)
+    if collection is None:
+        collection = cache.setdefault(key, app.state.chroma.get_or_create_collection(name=key))
+    return collection
+
+def has_documents(app, user_id: int) -> bool:
+    """
+    Whether this user has ingested anything, so callers can skip the
+    query embedding + Chroma round-trip for empty collections.
+    Only a non-empty answer is cached: another worker may ingest at any
+    time, and a local count() is far cheaper than the embedding it guards.
+    """
+    nonempty = app.state.collection_nonempty
+    if user_id in nonempty:
+        return True
+    if get_collection(app, user_id).count() > 0:
+        nonempty.add(user_id)
+        return True
+    return False
+
 @router.get("/api/models")
 def list_models(current_user: User = Depends(get_current_user)):
     """
@@ -138,67 +327,142 @@ def list_models(current_user: User = Depends(get_current_user)):
     return {"models": models, "default": default_payload}
 
 @router.get("/rag/health")
-def rag_health(current_user: User = Depends(get_current_user)):
+def rag_health(request: Request, current_user: User = Depends(get_current_user)):
     """
     Verify that the per-user Chroma collection can be opened/created.
     """
     if not CONTEXT_ENABLED:
         raise HTTPException(status_code=503, detail="RAG is disabled")
     try:
-        collection_name = f"documents_{current_user.id}"
-        client = get_chroma_client()
-        _ = init_collection(collection_name)
-        return {"status": "chroma ok", "collection": collection_name}
+        collection = get_collection(request.app, current_user.id)
+        return {"status": "chroma ok", "collection": collection.name}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Chroma health check failed: {e}")
 
 
+INGEST_READ_SIZE = 1 << 20   # bytes read (and decoded) per upload.read() call
+INGEST_BATCH_SIZE = 256      # chunks per aembed_chunks + collection.add round
+
 @router.post("/rag/ingest")
 async def ingest(
+    request: Request,
     files: List[UploadFile] = File(...),
     current_user: User = Depends(get_current_user),
 ):
     """
     Ingest uploaded files into this user’s Chroma collection.
+
+    Uploads are streamed in INGEST_READ_SIZE segments and chunked
+    incrementally; every INGEST_BATCH_SIZE chunks are embedded and added
+    while the next batch is being read/embedded.
     """
     if not CONTEXT_ENABLED:
         raise HTTPException(status_code=503, detail="RAG is disabled")
-    collection_name = f"documents_{current_user.id}"
-    all_texts: List[str] = []
-    all_ids: List[str] = []
-    all_metadatas: List[dict] = []
-
-    for upload in files:
-        raw = await upload.read()
-        text = raw.decode("utf-8", errors="ignore")
-        chunks = chunk_text(text)
-
-        base_name = upload.filename or "unknown"
-        for idx, chunk in enumerate(chunks):
-            # Prefix each ID with user_id so it can’t collide with others
-            chunk_id = f"{current_user.id}__{base_name}_chunk{idx}"
-            all_ids.append(chunk_id)
-            all_texts.append(chunk)
-            all_metadatas.append({
-                "source_file": base_name,
-                "chunk_index": idx,
-                "user_id": current_user.id,
-            })
-
-    embeddings = embed_chunks(all_texts)
-
-    collection = init_collection(collection_name)
-    collection.add(
-        ids=all_ids,
-        embeddings=embeddings,
-        metadatas=all_metadatas,
-        documents=all_texts,
-    )
+    collection = await run_in_threadpool(get_collection, request.app, current_user.id)
+
+    pending_ids: List[str] = []
+    pending_texts: List[str] = []
+    pending_metadatas: List[dict] = []
+    add_task: asyncio.Task | None = None
+    total = 0
+
+    async def flush():
+        nonlocal pending_ids, pending_texts, pending_metadatas, add_task
+        if not pending_texts:
+            return
+        ids, texts, metadatas = pending_ids, pending_texts, pending_metadatas
+        pending_ids, pending_texts, pending_metadatas = [], [], []
+        embeddings = await aembed_chunks(texts)
+        # Keep at most one add in flight: batch N-1 is written while batch N embeds
+        if add_task is not None:
+            await add_task
+        add_task = asyncio.create_task(
+            run_in_threadpool(
+                collection.add,
+                ids=ids,
+                embeddings=embeddings,
+                metadatas=metadatas,
+                documents=texts,
+            )
+        )
+
+    try:
+        for upload in files:
+            base_name = upload.filename or "unknown"
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+            chunker = StreamingChunker()
+            idx = 0
+            while True:
+                segment = await upload.read(INGEST_READ_SIZE)
+                final = not segment
+                # Tokenizing a 1 MiB segment is CPU work; keep it off the event loop
+                chunks = await run_in_threadpool(chunker.feed, decoder.decode(segment, final=final))
+                if final:
+                    chunks += await run_in_threadpool(chunker.finish)
+
+                for chunk in chunks:
+                    # Prefix each ID with user_id so it can’t collide with others
+                    pending_ids.append(f"{current_user.id}__{base_name}_chunk{idx}")
+                    pending_texts.append(chunk)
+                    pending_metadatas.append({
+                        "source_file": base_name,
+                        "chunk_index": idx,
+                        "user_id": current_user.id,
+                    })
+                    idx += 1
+                    total += 1
+                    if len(pending_texts) >= INGEST_BATCH_SIZE:
+                        await flush()
+                if final:
+                    break
+
+        await flush()
+    except BaseException:
+        # Don't leave a batch writing (or its exception unretrieved) after the request failed
+        if add_task is not None:
+            add_task.cancel()
+            with suppress(Exception, asyncio.CancelledError):
+                await add_task
+        raise
+    if add_task is not None:
+        await add_task
+    if total:
+        request.app.state.collection_nonempty.add(current_user.id)
     return {
-        "message": f"Ingested {len(all_ids)} chunks into Chroma for user {current_user.id}."
+        "message": f"Ingested {total} chunks into Chroma for user {current_user.id}."
     }
 
 
+def _select_model(
+    provider: str | None,
+    model: str | None,
+    session_meta: dict | None = None,
+) -> ModelSpec:
+    """
+    Resolve the (provider, model) to use in a single pass:
+      - an explicit provider+model must be available (400 otherwise),
+      - else the session's saved choice, if still available,
+      - else the deployment default (500 if nothing is configured).
+    """
+    provider = provider.lower() if provider else None
+    if provider and model:
+        spec = lookup_model(provider, model)
+        if not spec:
+            raise HTTPException(status_code=400, detail="Selected model is not available")
+        return spec
+    if provider or model:
+        raise HTTPException(status_code=400, detail="Both provider and model are required")
+
+    spec = None
+    if session_meta and "provider" in session_meta and "model" in session_meta:
+        spec = lookup_model(session_meta["provider"], session_meta["model"])
+    if spec is None:
+        spec = resolve_default_model()
+        if not spec:
+            raise HTTPException(status_code=500, detail="No models are configured")
+    return spec
+
+
 class RagAskRequest(BaseModel):
     query: str
     top_k: int = 5
@@ -208,6 +472,7 @@ class RagAskRequest(BaseModel):
 @router.post("/rag/ask")
 async def ask(
     req: RagAskRequest,
+    request: Request,
     current_user: User = Depends(get_current_user),
 ):
     """
@@ -218,21 +483,26 @@ async def ask(
     """
     if not CONTEXT_ENABLED:
         raise HTTPException(status_code=503, detail="RAG is disabled")
-    collection_name = f"documents_{current_user.id}"
-
-    # ─── 1) Time the embedding step ─────────────────────────────────────────────
-    t0 = time.time()
-    q_embedding = embed_query(req.query)
-    embed_duration = time.time() - t0
-
-    # ─── 2) Time the Chroma query step ─────────────────────────────────────────
-    collection = init_collection(collection_name)
-    t1 = time.time()
-    results = collection.query(
-        query_embeddings=[q_embedding],
-        n_results=req.top_k
-    )
-    chroma_duration = time.time() - t1
+
+    embed_duration = chroma_duration = 0.0
+    if await run_in_threadpool(has_documents, request.app, current_user.id):
+        # ─── 1) Time the embedding step ─────────────────────────────────────────
+        t0 = time.time()
+        q_embedding = await run_in_threadpool(embed_query, req.query)
+        embed_duration = time.time() - t0
+
+        # ─── 2) Time the Chroma query step ─────────────────────────────────────
+        collection = await run_in_threadpool(get_collection, request.app, current_user.id)
+        t1 = time.time()
+        results = await run_in_threadpool(
+            collection.query,
+            query_embeddings=[q_embedding],
+            n_results=req.top_k,
+        )
+        chroma_duration = time.time() - t1
+    else:
+        # Nothing ingested yet: skip the embedding API call and the Chroma query
+        results = {"ids": [[]], "documents": [[]], "metadatas": [[]]}
 
     chunks = results["documents"][0]
     metadatas = results["metadatas"][0]
@@ -241,26 +511,16 @@ async def ask(
     prompt_text = build_rag_prompt(chunks, req.query)
 
     # ─── 4) Time the GPT-4 Turbo API call ───────────────────────────────────────
-    selected_provider = req.provider.lower() if req.provider else None
-    selected_model = req.model
-    if selected_provider and selected_model:
-        if not lookup_model(selected_provider, selected_model):
-            raise HTTPException(status_code=400, detail="Selected model is not available")
-    elif selected_provider or selected_model:
-        raise HTTPException(status_code=400, detail="Both provider and model are required")
-    else:
-        default_spec = resolve_default_model()
-        if not default_spec:
-            raise HTTPException(status_code=500, detail="No models are configured")
-        selected_provider = default_spec.provider
-        selected_model = default_spec.model
+    spec = _select_model(req.provider, req.model)
+    selected_provider = spec.provider
+    selected_model = spec.model
 
     try:
         provider = build_provider(selected_provider)
     except RuntimeError as exc:
         raise HTTPException(status_code=500, detail=str(exc))
     t2 = time.time()
-    blended_answer = provider.chat(
+    blended_answer = await provider.achat(
         messages=[{"role": "user", "content": prompt_text}],
         model=selected_model,
         temperature=0.0,
@@ -297,44 +557,139 @@ async def ask(
 MEMORY_DIR = "memory_store"
 os.makedirs(MEMORY_DIR, exist_ok=True)
 
+def memory_lock(user_id: int) -> threading.RLock:
+    """
+    Per-user lock serializing MemoryStore loads, mutations and searches
+    (a FAISS index must not be searched while it is being added to or removed from).
+    """
+    lock = _memory_locks.get(user_id)
+    if lock is None:
+        with _memory_locks_guard:
+            lock = _memory_locks.setdefault(user_id, threading.RLock())
+    return lock
+
+def _memory_file_mtime(user_id: int) -> float | None:
+    try:
+        return os.path.getmtime(user_memory_file(user_id))
+    except OSError:
+        return None
+
 def get_memory_store(user_id: int) -> MemoryStore:
+    """
+    Return this user's cached MemoryStore, loading it from disk only on first
+    access or when another worker has rewritten the file since we loaded it.
+    """
     if not CONTEXT_ENABLED:
         raise RuntimeError("Context features are disabled")
-    store = _memory_stores.get(user_id)
-    if store is None:
-        store = MemoryStore()
-        _memory_stores[user_id] = store
+    with memory_lock(user_id):
+        store = _memory_stores.get(user_id)
+        if store is None:
+            store = MemoryStore()
+            store._loaded = False
+            store._loaded_mtime = None
+            _memory_stores[user_id] = store
+
+        mtime = _memory_file_mtime(user_id)
+        stale = mtime is not None and (store._loaded_mtime is None or mtime > store._loaded_mtime)
+        if not store._loaded or stale:
+            load_memory_for_user(user_id, store)
+            store._loaded = True
+            store._loaded_mtime = mtime
     return store
 
 def user_memory_file(user_id: int) -> str:
     """
-    Returns the path for a given user’s memory pickle file.
+    Returns the path for a given user’s memory (.npz) file.
     """
+    return os.path.join(MEMORY_DIR, f"memory_{user_id}.npz")
+
+def _legacy_memory_file(user_id: int) -> str:
     return os.path.join(MEMORY_DIR, f"memory_{user_id}.pkl")
 
+# Superseded index files younger than this are left alone: another worker may
+# have just written one and not yet committed the .npz that points at it.
+# Only the newest MEMORY_INDEX_MAX_STALE of them are kept even within it.
+MEMORY_INDEX_GRACE_SECONDS = 60
+MEMORY_INDEX_MAX_STALE = 2
+
+def _new_memory_index_file(user_id: int) -> str:
+    """
+    A fresh path for this user’s FAISS vector file. A persist that can't
+    append to the current file writes a new one and then atomically swaps the
+    .npz that references it, so readers (including ones that have the old file
+    memory-mapped) never see a torn pair.
+    """
+    return os.path.join(MEMORY_DIR, f"memory_{user_id}.{uuid.uuid4().hex}.index")
+
+def _remove_stale_memory_index_files(user_id: int, keep: str):
+    cutoff = time.time() - MEMORY_INDEX_GRACE_SECONDS
+    stale = []
+    for path in glob.glob(os.path.join(MEMORY_DIR, f"memory_{user_id}.*.index")):
+        if path != keep:
+            with suppress(OSError):
+                stale.append((os.path.getmtime(path), path))
+    stale.sort(reverse=True)
+    for rank, (mtime, path) in enumerate(stale):
+        if mtime < cutoff or rank >= MEMORY_INDEX_MAX_STALE:
+            with suppress(OSError):
+                os.remove(path)
+
 def load_memory_for_user(user_id: int, store: MemoryStore):
     """
     Load memory_store.texts & memory_store.embeddings from disk for this user.
+    A legacy pickle file is converted to .npz on first load.
     If no file exists, leave memory_store empty.
+
+    An .npz whose index file is missing or unreadable was most likely
+    superseded (and its index file cleaned up) while we were reading it, so
+    it is re-read once; if that fails too this raises rather than clearing
+    the store, which the next mutation would persist over the real memory.
     """
     path = user_memory_file(user_id)
+    legacy_path = _legacy_memory_file(user_id)
     if os.path.exists(path):
+        for attempt in range(2):
+            try:
+                with open(path, "rb") as f:
+                    store.load_file(f, MEMORY_DIR)
+                break
+            except Exception as e:
+                if attempt:
+                    print(f"Error loading memory for user {user_id}: {e}")
+                    raise HTTPException(
+                        status_code=503, detail="Memory is temporarily unavailable"
+                    )
+    elif os.path.exists(legacy_path):
         try:
-            with open(path, "rb") as f:
-                store.texts, store.embeddings = pickle.load(f)
+            with open(legacy_path, "rb") as f:
+                texts, embeddings = pickle.load(f)
+            store.load(texts, embeddings)
+            persist_memory_for_user(user_id, store)
         except Exception:
-            store.texts, store.embeddings = [], []
+            store.clear()
     else:
-        store.texts, store.embeddings = [], []
+        store.clear()
 
 def persist_memory_for_user(user_id: int, store: MemoryStore):
     """
-    Write this user’s memory_store.texts & embeddings to disk.
+    Write this user’s memory_store.texts & embeddings to disk: vectors to a
+    FAISS index file (memory-mapped on load), then the .npz pointing at it.
+    Pure additions are appended to the current index file in place; only a
+    remove/clear (or a file changed by another worker) writes a new one.
     """
     path = user_memory_file(user_id)
     try:
-        with open(path, "wb") as f:
-            pickle.dump((store.texts, store.embeddings), f)
+        index_path = store.index_file
+        if index_path is None or not store.append_index():
+            index_path = _new_memory_index_file(user_id)
+            with _atomic_open(index_path) as f:
+                store.save_index(f)
+            store.bind_index_file(index_path)
+        with _atomic_open(path) as f:
+            store.save(f, index_file=os.path.basename(index_path))
+        # Our own write shouldn't look like a foreign change on the next access
+        store._loaded_mtime = _memory_file_mtime(user_id)
+        _remove_stale_memory_index_files(user_id, keep=index_path)
     except Exception as e:
         print(f"Error persisting memory for user {user_id}: {e}")
 
@@ -351,12 +706,8 @@ async def ask_memory(
     """
     if not CONTEXT_ENABLED:
         raise HTTPException(status_code=503, detail="Memory is disabled")
-    # 1) Load this user’s memory from disk into memory_store
-    store = get_memory_store(current_user.id)
-    load_memory_for_user(current_user.id, store)
-
-    # 2) Perform retrieval over memory_store
-    memory_results = store.query(req.query, top_k=3)
+    # 1+2) Load this user’s (cached) memory_store and retrieve, off the event loop
+    memory_results = await run_in_threadpool(_memory_ctx, current_user.id, req.query)
     memory_context = "\n---\n".join(memory_results)
 
     enriched_query = (
@@ -370,7 +721,7 @@ async def ask_memory(
         provider = build_provider(default_spec.provider)
     except RuntimeError as exc:
         raise HTTPException(status_code=500, detail=str(exc))
-    answer = provider.chat(
+    answer = await provider.achat(
         messages=[{"role": "user", "content": enriched_query}],
         model=default_spec.model,
         temperature=0.0,
@@ -378,7 +729,7 @@ async def ask_memory(
     return {"answer": answer, "provider": default_spec.provider, "model": default_spec.model}
 
 @router.post("/upload")
-async def upload_memory(
+def upload_memory(
     file: UploadFile = File(...),
     current_user: User = Depends(get_current_user),
 ):
@@ -387,24 +738,23 @@ async def upload_memory(
     """
     if not CONTEXT_ENABLED:
         raise HTTPException(status_code=503, detail="Memory is disabled")
-    store = get_memory_store(current_user.id)
-    load_memory_for_user(current_user.id, store)
-
     if file.filename.endswith(".pdf"):
         from PyPDF2 import PdfReader  # local import
         pdf_reader = PdfReader(file.file)
         text = "\n".join(page.extract_text() or "" for page in pdf_reader.pages)
     else:
-        contents = await file.read()
+        contents = file.file.read()
         text = contents.decode("utf-8", errors="ignore")
 
-    store.add([text])
-    persist_memory_for_user(current_user.id, store)
+    with memory_lock(current_user.id):
+        store = get_memory_store(current_user.id)
+        store.add([text])
+        persist_memory_for_user(current_user.id, store)
 
     return {"status": "File processed and added to your memory"}
 
 @router.get("/memory")
-async def memory_debug(
+def memory_debug(
     current_user: User = Depends(get_current_user),
 ):
     """
@@ -413,13 +763,12 @@ async def memory_debug(
     if not CONTEXT_ENABLED:
         raise HTTPException(status_code=503, detail="Memory is disabled")
     store = get_memory_store(current_user.id)
-    load_memory_for_user(current_user.id, store)
     html = "".join(f"<p>{i+1}. {entry[:300]}...</p>"
                    for i, entry in enumerate(store.texts[:3]))
     return HTMLResponse(content=f"<html><body><h2>Your Memory Preview</h2>{html}</body></html>")
 
 @router.get("/api/memory")
-async def get_memory(
+def get_memory(
     offset: int = 0,
     limit: int = 10,
     current_user: User = Depends(get_current_user),
@@ -430,12 +779,11 @@ async def get_memory(
     if not CONTEXT_ENABLED:
         raise HTTPException(status_code=503, detail="Memory is disabled")
     store = get_memory_store(current_user.id)
-    load_memory_for_user(current_user.id, store)
     preview = store.texts[offset : offset + limit]
-    return JSONResponse(content={"memory": preview})
+    return {"memory": preview}
 
 @router.post("/remember")
-async def remember(
+def remember(
     item: AskRequest,
     current_user: User = Depends(get_current_user),
 ):
@@ -444,14 +792,14 @@ async def remember(
     """
     if not CONTEXT_ENABLED:
         raise HTTPException(status_code=503, detail="Memory is disabled")
-    store = get_memory_store(current_user.id)
-    load_memory_for_user(current_user.id, store)
-    store.add([item.query])
-    persist_memory_for_user(current_user.id, store)
+    with memory_lock(current_user.id):
+        store = get_memory_store(current_user.id)
+        store.add([item.query])
+        persist_memory_for_user(current_user.id, store)
     return {"status": "Remembered"}
 
 @router.delete("/api/memory/{index}")
-async def delete_memory(
+def delete_memory(
     index: int,
     current_user: User = Depends(get_current_user),
 ):
@@ -460,18 +808,17 @@ async def delete_memory(
     """
     if not CONTEXT_ENABLED:
         raise HTTPException(status_code=503, detail="Memory is disabled")
-    store = get_memory_store(current_user.id)
-    load_memory_for_user(current_user.id, store)
-    try:
-        del store.texts[index]
-        del store.embeddings[index]
-        persist_memory_for_user(current_user.id, store)
-        return {"status": f"Deleted memory at index {index}"}
-    except IndexError:
-        raise HTTPException(status_code=404, detail="Memory index not found")
+    with memory_lock(current_user.id):
+        store = get_memory_store(current_user.id)
+        try:
+            store.remove(index)
+            persist_memory_for_user(current_user.id, store)
+            return {"status": f"Deleted memory at index {index}"}
+        except IndexError:
+            raise HTTPException(status_code=404, detail="Memory index not found")
 
 @router.delete("/api/memory")
-async def clear_memory(
+def clear_memory(
     current_user: User = Depends(get_current_user),
 ):
     """
@@ -479,10 +826,10 @@ async def clear_memory(
     """
     if not CONTEXT_ENABLED:
         raise HTTPException(status_code=503, detail="Memory is disabled")
-    store = get_memory_store(current_user.id)
-    store.texts.clear()
-    store.embeddings.clear()
-    persist_memory_for_user(current_user.id, store)
+    with memory_lock(current_user.id):
+        store = get_memory_store(current_user.id)
+        store.clear()
+        persist_memory_for_user(current_user.id, store)
     return {"status": "All memory cleared"}
 
 
@@ -495,6 +842,7 @@ class ChatMessage(BaseModel):
     session_id: str | None = None
     provider: str | None = None
     model: str | None = None
+    stream: bool = False
 
 @router.get("/api/history")
 def get_history(
@@ -509,28 +857,165 @@ def get_history(
     return {"messages": messages, "session": session_meta}
 
 
+def _memory_ctx(user_id: int, message: str) -> List[str]:
+    """
+    Top‐3 MemoryStore entries for this message (local encode + FAISS search).
+    """
+    with memory_lock(user_id):
+        store = get_memory_store(user_id)
+        if not store.texts:
+            return []
+        return store.query(message, top_k=3)
+
+def _chroma_ctx(app, user_id: int, q_embedding: list[float]) -> List[str]:
+    """
+    Top‐3 documents from this user's Chroma collection for a query embedding.
+    """
+    collection = get_collection(app, user_id)
+    results = collection.query(query_embeddings=[q_embedding], n_results=3)
+    return results["documents"][0]
+
+async def _gather_chat_context(app, user_id: int, message: str) -> tuple[List[str], List[str]]:
+    """
+    Run MemoryStore retrieval concurrently with the embed + Chroma lookup;
+    latency is the slower of the two rather than their sum. The embed +
+    Chroma leg is skipped entirely for users with no ingested documents.
+    """
+    memory_task = asyncio.create_task(run_in_threadpool(_memory_ctx, user_id, message))
+    try:
+        if not await run_in_threadpool(has_documents, app, user_id):
+            return await memory_task, []
+        q_embedding = await run_in_threadpool(embed_query, message)
+    except BaseException:
+        memory_task.cancel()
+        raise
+    memory_results, chroma_chunks = await asyncio.gather(
+        memory_task,
+        run_in_threadpool(_chroma_ctx, app, user_id, q_embedding),
+    )
+    return memory_results, chroma_chunks
+
+# Constant prompt pieces for /api/chat, assembled with a single "".join
+_CHAT_PROMPT_WITH_CONTEXT = (
+    "You are a helpful assistant. Below is some context that has been "
+    "retrieved from the user’s prior “memory” and from uploaded documents:\n\n"
+)
+_CHAT_PROMPT_NO_CONTEXT = "You are a helpful assistant. Answer as best you can.\n\n"
+_CHAT_PROMPT_CONVERSATION = "Conversation so far:\n"
+_CHAT_PROMPT_QUESTION = "\n\nUser’s Question: "
+_CHAT_PROMPT_ANSWER = "\nAssistant’s Answer:"
+
+def _build_chat_prompt(
+    memory_results: List[str],
+    chroma_chunks: List[str],
+    conversation_context: str,
+    message: str,
+) -> str:
+    """
+    Blend retrieved MemoryStore/Chroma context and the recent conversation
+    into a single prompt for /api/chat.
+    """
+    memory_context = "\n--- Memory Context ---\n".join(memory_results)
+    chroma_context = "\n--- Retrieved Context ---\n".join(chroma_chunks)
+    combined_context = "\n---\n".join(c for c in (memory_context, chroma_context) if c)
+
+    if combined_context:
+        parts = [_CHAT_PROMPT_WITH_CONTEXT, combined_context, "\n\n", _CHAT_PROMPT_CONVERSATION]
+    else:
+        parts = [_CHAT_PROMPT_NO_CONTEXT, _CHAT_PROMPT_CONVERSATION]
+    parts += [conversation_context, _CHAT_PROMPT_QUESTION, message, _CHAT_PROMPT_ANSWER]
+    return "".join(parts)
+
+
+def _sse(event: str, data) -> bytes:
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+
+async def _stream_chat_reply(
+    provider: LLMProvider,
+    prompt_text: str,
+    user_id: int,
+    session_id: str,
+    session_meta: dict,
+):
+    """
+    Yield the assistant reply as SSE events:
+      session → {"session", "session_id"} once up front,
+      delta   → a JSON string per text fragment,
+      done    → {"reply", "session", "session_id"} at the end,
+      error   → {"provider", "model", "error"} if the provider fails.
+    The accumulated reply is appended to the history once, when the stream
+    closes, unless the provider failed: like the non-streaming path, a
+    truncated reply is not saved (it would be quoted back on the next turn).
+    """
+    parts: List[str] = []
+    failed = False
+    yield _sse("session", {"session": session_meta, "session_id": session_id})
+    try:
+        async for delta in provider.chat_stream(
+            messages=[{"role": "user", "content": prompt_text}],
+            model=session_meta["model"],
+            temperature=0.0,
+        ):
+            parts.append(delta)
+            yield _sse("delta", delta)
+        yield _sse("done", {"reply": "".join(parts), "session": session_meta, "session_id": session_id})
+    except Exception as exc:
+        failed = True
+        yield _sse(
+            "error",
+            {
+                "provider": session_meta.get("provider"),
+                "model": session_meta.get("model"),
+                "error": str(exc),
+            },
+        )
+    finally:
+        if parts and not failed:
+            assistant_message = {
+                "role": "assistant",
+                "content": "".join(parts),
+                "provider": session_meta.get("provider"),
+                "model": session_meta.get("model"),
+            }
+            # Persist even if the client disconnected mid-stream
+            with anyio.CancelScope(shield=True):
+                await run_in_threadpool(append_message, user_id, session_id, assistant_message)
+
+
+# Messages (including the new one) quoted back to the model as conversation context
+CHAT_CONTEXT_MESSAGES = 12
+
 @router.post("/api/chat")
-def post_message(
+async def post_message(
     msg: ChatMessage,
+    request: Request,
     current_user: User = Depends(get_current_user),
 ):
     """
     1) Append the user’s message to their chat history file,
        then generate an assistant reply using BOTH MemoryStore and RAG.
     2) Append the assistant message, persist again, and return it.
+       With `stream: true` the reply is sent as Server-Sent Events instead
+       (see _stream_chat_reply) and persisted once the stream ends.
+
+    Disk, embedding and Chroma work runs in the threadpool; only the
+    provider call is awaited on the event loop.
     """
     session_id = _normalize_session_id(msg.session_id)
 
-    # 1) Load existing history
-    chat_history, session_meta = load_chat_history(current_user.id, session_id)
+    # 1) Load the tail of the existing history (all the prompt uses)
+    chat_history, session_meta = await run_in_threadpool(
+        load_recent_chat_history, current_user.id, session_id, CHAT_CONTEXT_MESSAGES - 1
+    )
 
     # 2) Append user message + persist
-    chat_history.append({"role": "user", "content": msg.message})
-    persist_chat_history(current_user.id, session_id, chat_history, session_meta)
+    user_message = {"role": "user", "content": msg.message}
+    chat_history.append(user_message)
+    await run_in_threadpool(append_message, current_user.id, session_id, user_message)
 
     # Build conversation context from recent messages (exclude assistant errors)
     recent_history = [
-        m for m in chat_history[-12:]
+        m for m in chat_history[-CHAT_CONTEXT_MESSAGES:]
         if isinstance(m, dict) and m.get("role") in {"user", "assistant"}
     ]
     conversation_context = "\n".join(
@@ -538,95 +1023,38 @@ def post_message(
     )
 
     if CONTEXT_ENABLED:
-        # ───────────────────────────
-        # 2A) Load this user's MemoryStore from disk
-        # ───────────────────────────
-        store = get_memory_store(current_user.id)
-        load_memory_for_user(current_user.id, store)
-
-        # 2B) Retrieve top‐3 memory chunks (strings) relevant to this query
-        memory_results = store.query(msg.message, top_k=3)
-        memory_context = "\n--- Memory Context ---\n".join(memory_results) if memory_results else ""
-
-        # ───────────────────────────
-        # 2C) Retrieve top‐3 documents from this user's Chroma collection
-        # ───────────────────────────
-        q_embedding = embed_query(msg.message)
-        collection_name = f"documents_{current_user.id}"
-        collection = init_collection(collection_name)
-        results = collection.query(query_embeddings=[q_embedding], n_results=3)
-
-        chroma_chunks = results["documents"][0]
-        chroma_context = "\n--- Retrieved Context ---\n".join(chroma_chunks) if chroma_chunks else ""
-
-        # ───────────────────────────
-        # 2D) Build a single blended prompt string
-        # ───────────────────────────
-        if memory_context and chroma_context:
-            combined_context = f"{memory_context}\n---\n{chroma_context}"
-        else:
-            combined_context = memory_context or chroma_context
-
-        if combined_context:
-            prompt_text = (
-                "You are a helpful assistant. Below is some context that has been "
-                "retrieved from the user’s prior “memory” and from uploaded documents:\n\n"
-                f"{combined_context}\n\n"
-                "Conversation so far:\n"
-                f"{conversation_context}\n\n"
-                f"User’s Question: {msg.message}\n"
-                "Assistant’s Answer:"
-            )
-        else:
-            prompt_text = (
-                "You are a helpful assistant. Answer as best you can.\n\n"
-                f"Conversation so far:\n{conversation_context}\n\n"
-                f"User’s Question: {msg.message}\n"
-                "Assistant’s Answer:"
-            )
-    else:
-        prompt_text = (
-            "You are a helpful assistant. Answer as best you can.\n\n"
-            f"Conversation so far:\n{conversation_context}\n\n"
-            f"User’s Question: {msg.message}\n"
-            "Assistant’s Answer:"
+        memory_results, chroma_chunks = await _gather_chat_context(
+            request.app, current_user.id, msg.message
         )
+    else:
+        memory_results, chroma_chunks = [], []
+    prompt_text = _build_chat_prompt(memory_results, chroma_chunks, conversation_context, msg.message)
 
     # ───────────────────────────
     # 3) Single ChatGPT call
     # ───────────────────────────
-    selected_provider = msg.provider.lower() if msg.provider else None
-    selected_model = msg.model
-    if selected_provider and selected_model:
-        if not lookup_model(selected_provider, selected_model):
-            raise HTTPException(status_code=400, detail="Selected model is not available")
-        session_meta["provider"] = selected_provider
-        session_meta["model"] = selected_model
-    elif selected_provider or selected_model:
-        raise HTTPException(status_code=400, detail="Both provider and model are required")
-    else:
-        if "provider" not in session_meta or "model" not in session_meta:
-            default_spec = resolve_default_model()
-            if not default_spec:
-                raise HTTPException(status_code=500, detail="No models are configured")
-            session_meta["provider"] = default_spec.provider
-            session_meta["model"] = default_spec.model
-
-    if not lookup_model(session_meta["provider"], session_meta["model"]):
-        default_spec = resolve_default_model()
-        if not default_spec:
-            raise HTTPException(status_code=500, detail="No models are configured")
-        session_meta["provider"] = default_spec.provider
-        session_meta["model"] = default_spec.model
+    previous_meta = dict(session_meta)
+    spec = _select_model(msg.provider, msg.model, session_meta)
+    session_meta["provider"] = spec.provider
+    session_meta["model"] = spec.model
 
-    persist_chat_history(current_user.id, session_id, chat_history, session_meta)
+    if session_meta != previous_meta:
+        await run_in_threadpool(persist_session_meta, current_user.id, session_id, session_meta)
 
     try:
         provider = build_provider(session_meta["provider"])
     except RuntimeError as exc:
         raise HTTPException(status_code=500, detail=str(exc))
+
+    if msg.stream:
+        return StreamingResponse(
+            _stream_chat_reply(provider, prompt_text, current_user.id, session_id, session_meta),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
     try:
-        reply_text = provider.chat(
+        reply_text = await provider.achat(
             messages=[{"role": "user", "content": prompt_text}],
             model=session_meta["model"],
             temperature=0.0,
@@ -642,14 +1070,13 @@ def post_message(
         )
 
     # 4) Append assistant message + persist again
-    chat_history.append(
-        {
-            "role": "assistant",
-            "content": reply_text,
-            "provider": session_meta.get("provider"),
-            "model": session_meta.get("model"),
-        }
-    )
-    persist_chat_history(current_user.id, session_id, chat_history, session_meta)
+    assistant_message = {
+        "role": "assistant",
+        "content": reply_text,
+        "provider": session_meta.get("provider"),
+        "model": session_meta.get("model"),
+    }
+    chat_history.append(assistant_message)
+    await run_in_threadpool(append_message, current_user.id, session_id, assistant_message)
 
     return {"reply": reply_text, "session": session_meta, "session_id": session_id}
@@ -1,13 +1,41 @@
+from contextlib import asynccontextmanager
+
+import httpx
 from fastapi import FastAPI, UploadFile, Form
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 
-from app.api.routes import router
+from app.api.routes import router, CONTEXT_ENABLED, get_chroma_client
 from app.api import auth
+from app.services.llm_providers import close_clients, prewarm_connections
 
 # Import these two so we can auto-create tables
 from app.database import engine, Base
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pooled async client for outbound calls (e.g. Turnstile verification)
+    app.state.http = httpx.AsyncClient(
+        timeout=10.0,
+        limits=httpx.Limits(max_keepalive_connections=50),
+    )
+    # Open the Chroma client once; per-user collections are resolved lazily
+    # and cached here by app.api.routes.get_collection
+    if CONTEXT_ENABLED:
+        app.state.chroma = get_chroma_client()
+    app.state.collection_cache = {}
+    app.state.collection_nonempty = set()
+    # Warm the shared provider connection pool before the first chat request
+    await prewarm_connections()
+    try:
+        yield
+    finally:
+        await app.state.http.aclose()
+        await close_clients()
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # === AUTO-CREATE TABLES HERE ===
 Base.metadata.create_all(bind=engine)
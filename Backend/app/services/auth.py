@@ -1,7 +1,10 @@
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from jose import JWTError, jwt
 from passlib.context import CryptContext
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 from sqlalchemy.orm import Session
 from app.models import user as models
 from app.core.config import SECRET_KEY, ALGORITHM
@@ -35,8 +38,66 @@ def create_refresh_token(data: dict, expires_delta: timedelta):
     refresh_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return refresh_jwt
 
+# Decoded JWT payloads keyed by the raw token string. Entries live for at most
+# _JWT_CACHE_TTL seconds (never past the token's own exp) so repeat requests
+# with the same token skip the signature check + JSON parse.
+_JWT_CACHE_MAXSIZE = 4096
+_JWT_CACHE_TTL = 60.0
+_jwt_cache: "OrderedDict[str, tuple[float, dict]]" = OrderedDict()
+_jwt_cache_lock = threading.Lock()
+
+def decode_token_cached(token: str) -> dict:
+    """
+    jwt.decode with a small LRU/TTL cache in front of it.
+    Raises JWTError exactly like jwt.decode on invalid or expired tokens.
+    """
+    now = time.time()
+    with _jwt_cache_lock:
+        hit = _jwt_cache.get(token)
+        if hit is not None:
+            if hit[0] > now:
+                _jwt_cache.move_to_end(token)
+                return hit[1]
+            del _jwt_cache[token]
+
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    expires_at = min(float(payload.get("exp", now)), now + _JWT_CACHE_TTL)
+    with _jwt_cache_lock:
+        _jwt_cache[token] = (expires_at, payload)
+        _jwt_cache.move_to_end(token)
+        while len(_jwt_cache) > _JWT_CACHE_MAXSIZE:
+            _jwt_cache.popitem(last=False)
+    return payload
+
+# email -> primary key for users we've already found, so repeat lookups are a
+# primary-key get (served from the Session identity map when possible)
+# instead of the WHERE email = ? query.
+_USER_ID_CACHE_MAXSIZE = 1024
+_user_id_by_email: "OrderedDict[str, int]" = OrderedDict()
+_user_id_lock = threading.Lock()
+
+def forget_user_email(email: str) -> None:
+    with _user_id_lock:
+        _user_id_by_email.pop(email, None)
+
 def get_user_by_email(db: Session, email: str):
-    return db.query(models.User).filter(models.User.email == email).first()
+    with _user_id_lock:
+        user_id = _user_id_by_email.get(email)
+        if user_id is not None:
+            _user_id_by_email.move_to_end(email)
+    if user_id is not None:
+        user = db.get(models.User, user_id)
+        if user is not None and user.email == email:
+            return user
+        forget_user_email(email)
+
+    user = db.query(models.User).filter(models.User.email == email).first()
+    if user is not None:
+        with _user_id_lock:
+            _user_id_by_email[email] = user.id
+            while len(_user_id_by_email) > _USER_ID_CACHE_MAXSIZE:
+                _user_id_by_email.popitem(last=False)
+    return user
 
 def authenticate_user(db: Session, email: str, password: str):
     user = get_user_by_email(db, email)
@@ -49,20 +110,26 @@ def authenticate_user(db: Session, email: str, password: str):
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 
 def get_current_user(
+    request: Request,
     token: str = Depends(oauth2_scheme),
     db: Session = Depends(get_db)
 ) -> User:
     """
     Dependency to verify the bearer token, look up the user by email,
     and return the SQLAlchemy User. Raises a 401 if invalid or not found.
+    The user is kept on request.state.user for reuse within the request.
     """
+    cached = getattr(request.state, "user", None)
+    if cached is not None:
+        return cached
+
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = decode_token_cached(token)
         email: str = payload.get("sub")
         if email is None:
             raise credentials_exception
@@ -72,4 +139,5 @@ def get_current_user(
     user = get_user_by_email(db, email)
     if user is None:
         raise credentials_exception
+    request.state.user = user
     return user
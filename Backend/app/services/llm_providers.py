@@ -1,20 +1,71 @@
 from __future__ import annotations
 
+import asyncio
+import json
 import os
+import random
+import time
 from dataclasses import dataclass
-from typing import List, Optional, Protocol
+from functools import lru_cache
+from typing import AsyncIterator, List, Optional, Protocol
 
 import httpx
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# One pooled HTTP/2 client pair per process, shared by every provider, so
+# TCP+TLS handshakes are paid once per host rather than per call or provider.
+_HTTP_TIMEOUT = httpx.Timeout(60.0, connect=10.0)
+_HTTP_LIMITS = httpx.Limits(
+    max_connections=200, max_keepalive_connections=100, keepalive_expiry=60.0
+)
+_http_client = httpx.Client(http2=True, timeout=_HTTP_TIMEOUT, limits=_HTTP_LIMITS)
+_async_http_client = httpx.AsyncClient(http2=True, timeout=_HTTP_TIMEOUT, limits=_HTTP_LIMITS)
+
+# Bounded retry for transient provider failures (429, 5xx, dropped connections).
+# The OpenAI SDK already retries internally; this covers the raw-httpx providers.
+RETRY_ATTEMPTS = 3
+RETRY_INITIAL_WAIT = 0.2
+RETRY_MAX_WAIT = 2.0
+
+
+def _is_transient(exc: Exception) -> bool:
+    if isinstance(exc, httpx.HTTPStatusError):
+        status = exc.response.status_code
+        return status == 429 or status >= 500
+    return isinstance(exc, httpx.TransportError)
+
+
+def _retry_wait(attempt: int) -> float:
+    # Exponential backoff with full jitter so concurrent retries don't align
+    return random.uniform(0, min(RETRY_MAX_WAIT, RETRY_INITIAL_WAIT * 2 ** attempt))
+
+OPENAI_BASE_URL = "https://api.openai.com/v1"
+ANTHROPIC_ENDPOINT = "https://api.anthropic.com/v1/messages"
+
+# Provider credentials are read once at import, not on every build_provider call
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
+DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
+DEEPSEEK_BASE_URL = os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com/v1")
+TOGETHER_API_KEY = os.getenv("TOGETHER_API_KEY")
+TOGETHER_BASE_URL = os.getenv("TOGETHER_BASE_URL", "https://api.together.xyz/v1")
+
 
 class LLMProvider(Protocol):
     def chat(self, messages: List[dict], model: str, temperature: float = 0.0) -> str:
         ...
 
+    async def achat(self, messages: List[dict], model: str, temperature: float = 0.0) -> str:
+        ...
+
+    def chat_stream(
+        self, messages: List[dict], model: str, temperature: float = 0.0
+    ) -> AsyncIterator[str]:
+        ...
+
 
 @dataclass(frozen=True)
 class ModelSpec:
@@ -24,12 +75,20 @@ class ModelSpec:
     max_output_tokens: Optional[int] = None
 
 
+@lru_cache(maxsize=None)
+def _openai_clients(api_key: str, base_url: Optional[str]) -> tuple[OpenAI, AsyncOpenAI]:
+    client_kwargs = {"api_key": api_key}
+    if base_url:
+        client_kwargs["base_url"] = base_url
+    return (
+        OpenAI(**client_kwargs, http_client=_http_client),
+        AsyncOpenAI(**client_kwargs, http_client=_async_http_client),
+    )
+
+
 class OpenAIProvider:
     def __init__(self, api_key: str, base_url: Optional[str] = None) -> None:
-        client_kwargs = {"api_key": api_key}
-        if base_url:
-            client_kwargs["base_url"] = base_url
-        self._client = OpenAI(**client_kwargs)
+        self._client, self._async_client = _openai_clients(api_key, base_url)
 
     def chat(self, messages: List[dict], model: str, temperature: float = 0.0) -> str:
         resp = self._client.chat.completions.create(
@@ -39,12 +98,37 @@ class OpenAIProvider:
         )
         return resp.choices[0].message.content or ""
 
+    async def achat(self, messages: List[dict], model: str, temperature: float = 0.0) -> str:
+        resp = await self._async_client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+        )
+        return resp.choices[0].message.content or ""
+
+    async def chat_stream(
+        self, messages: List[dict], model: str, temperature: float = 0.0
+    ) -> AsyncIterator[str]:
+        stream = await self._async_client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            stream=True,
+        )
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
+
 
 class AnthropicProvider:
     def __init__(self, api_key: str) -> None:
         self._api_key = api_key
-        self._endpoint = "https://api.anthropic.com/v1/messages"
-        self._client = httpx.Client(timeout=60.0)
+        self._endpoint = ANTHROPIC_ENDPOINT
+        self._client = _http_client
+        self._async_client = _async_http_client
 
     def _build_payload(self, messages: List[dict], model: str, temperature: float) -> dict:
         system_messages: List[str] = []
@@ -67,43 +151,129 @@ class AnthropicProvider:
             payload["system"] = "\n".join(system_messages)
         return payload
 
-    def chat(self, messages: List[dict], model: str, temperature: float = 0.0) -> str:
-        headers = {
+    def _headers(self) -> dict:
+        return {
             "x-api-key": self._api_key,
             "anthropic-version": "2023-06-01",
             "content-type": "application/json",
         }
-        payload = self._build_payload(messages, model, temperature)
-        resp = self._client.post(self._endpoint, headers=headers, json=payload)
-        resp.raise_for_status()
-        data = resp.json()
+
+    @staticmethod
+    def _extract_text(data: dict) -> str:
         # Claude response content is a list of blocks
         parts = data.get("content", [])
         return "".join(part.get("text", "") for part in parts)
 
+    def chat(self, messages: List[dict], model: str, temperature: float = 0.0) -> str:
+        payload = self._build_payload(messages, model, temperature)
+        for attempt in range(RETRY_ATTEMPTS):
+            try:
+                resp = self._client.post(self._endpoint, headers=self._headers(), json=payload)
+                resp.raise_for_status()
+                return self._extract_text(resp.json())
+            except httpx.HTTPError as exc:
+                if attempt == RETRY_ATTEMPTS - 1 or not _is_transient(exc):
+                    raise
+                time.sleep(_retry_wait(attempt))
+        raise AssertionError("unreachable")
+
+    async def achat(self, messages: List[dict], model: str, temperature: float = 0.0) -> str:
+        payload = self._build_payload(messages, model, temperature)
+        for attempt in range(RETRY_ATTEMPTS):
+            try:
+                resp = await self._async_client.post(
+                    self._endpoint, headers=self._headers(), json=payload
+                )
+                resp.raise_for_status()
+                return self._extract_text(resp.json())
+            except httpx.HTTPError as exc:
+                if attempt == RETRY_ATTEMPTS - 1 or not _is_transient(exc):
+                    raise
+                await asyncio.sleep(_retry_wait(attempt))
+        raise AssertionError("unreachable")
 
+    async def chat_stream(
+        self, messages: List[dict], model: str, temperature: float = 0.0
+    ) -> AsyncIterator[str]:
+        payload = self._build_payload(messages, model, temperature)
+        payload["stream"] = True
+        async with self._async_client.stream(
+            "POST", self._endpoint, headers=self._headers(), json=payload
+        ) as resp:
+            if resp.is_error:
+                await resp.aread()
+                resp.raise_for_status()
+            # Server-sent events; text arrives in content_block_delta events
+            async for line in resp.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                event = json.loads(line[len("data:"):])
+                if event.get("type") == "error":
+                    raise RuntimeError(event.get("error", {}).get("message", "stream error"))
+                if event.get("type") != "content_block_delta":
+                    continue
+                delta = event.get("delta", {})
+                if delta.get("type") == "text_delta":
+                    yield delta.get("text", "")
+
+
+@lru_cache(maxsize=None)
 def build_provider(provider: str) -> LLMProvider:
+    """
+    Return the process-wide provider instance for `provider`. Cached, so every
+    caller shares one set of pooled clients; errors are not cached.
+    """
     provider = provider.lower()
     if provider == "openai":
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
+        if not OPENAI_API_KEY:
             raise RuntimeError("OPENAI_API_KEY is not set")
-        return OpenAIProvider(api_key=api_key)
+        return OpenAIProvider(api_key=OPENAI_API_KEY)
     if provider == "deepseek":
-        api_key = os.getenv("DEEPSEEK_API_KEY")
-        if not api_key:
+        if not DEEPSEEK_API_KEY:
             raise RuntimeError("DEEPSEEK_API_KEY is not set")
-        base_url = os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com/v1")
-        return OpenAIProvider(api_key=api_key, base_url=base_url)
+        return OpenAIProvider(api_key=DEEPSEEK_API_KEY, base_url=DEEPSEEK_BASE_URL)
     if provider == "together":
-        api_key = os.getenv("TOGETHER_API_KEY")
-        if not api_key:
+        if not TOGETHER_API_KEY:
             raise RuntimeError("TOGETHER_API_KEY is not set")
-        base_url = os.getenv("TOGETHER_BASE_URL", "https://api.together.xyz/v1")
-        return OpenAIProvider(api_key=api_key, base_url=base_url)
+        return OpenAIProvider(api_key=TOGETHER_API_KEY, base_url=TOGETHER_BASE_URL)
     if provider == "anthropic":
-        api_key = os.getenv("ANTHROPIC_API_KEY")
-        if not api_key:
+        if not ANTHROPIC_API_KEY:
             raise RuntimeError("ANTHROPIC_API_KEY is not set")
-        return AnthropicProvider(api_key=api_key)
+        return AnthropicProvider(api_key=ANTHROPIC_API_KEY)
     raise RuntimeError(f"Unsupported provider: {provider}")
+
+
+def _configured_base_urls() -> List[str]:
+    urls = []
+    if OPENAI_API_KEY:
+        urls.append(OPENAI_BASE_URL)
+    if DEEPSEEK_API_KEY:
+        urls.append(DEEPSEEK_BASE_URL)
+    if TOGETHER_API_KEY:
+        urls.append(TOGETHER_BASE_URL)
+    if ANTHROPIC_API_KEY:
+        urls.append(ANTHROPIC_ENDPOINT)
+    return urls
+
+
+async def prewarm_connections() -> None:
+    """
+    Open a pooled connection (TCP + TLS + HTTP/2) to each configured provider
+    with a HEAD request, so the first user-visible call skips the handshake.
+    Failures are ignored; the request path connects on demand anyway.
+    """
+    async def _head(url: str) -> None:
+        try:
+            await _async_http_client.head(url, timeout=5.0)
+        except httpx.HTTPError:
+            pass
+
+    await asyncio.gather(*(_head(url) for url in _configured_base_urls()))
+
+
+async def close_clients() -> None:
+    """
+    Close the shared HTTP pools; called once at application shutdown.
+    """
+    _http_client.close()
+    await _async_http_client.aclose()
@@ -1,32 +1,556 @@
-from typing import List
-from sentence_transformers import SentenceTransformer, util
+import os
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import List, Optional, Sequence, Union
+import orjson
 import numpy as np
-import torch
+import faiss
 
-_MODEL = SentenceTransformer("all-MiniLM-L6-v2")
+try:
+    import fcntl
+except ImportError:  # not POSIX: index files are always rewritten, never appended to
+    fcntl = None
+
+# One large batch per call: inputs are sorted by length, so a wide batch
+# means fewer, denser forward passes with little padding
+ENCODE_BATCH_SIZE = 1024
+
+# Directory holding an ONNX export of all-MiniLM-L6-v2, e.g. from
+#   optimum-cli export onnx --model sentence-transformers/all-MiniLM-L6-v2 \
+#       --task feature-extraction onnx/
+# When set, embeddings run through ONNX Runtime with INT8 weights instead of torch.
+EMBED_ONNX_DIR = os.getenv("EMBED_ONNX_DIR")
+
+# Run the torch encoder under reduced-precision autocast (bf16 on CPU, fp16 on
+# GPU). Off by default: CPUs without native BF16 (AVX512-BF16/AMX) get slower.
+EMBED_AUTOCAST = os.getenv("EMBED_AUTOCAST", "false").lower() == "true"
+
+# Compile the torch encoder's transformer with torch.compile. Similarity search
+# already runs in FAISS's native kernels, so the forward pass is the part left
+# paying Python dispatch per op. Opt-in: the first encode pays compile time.
+EMBED_COMPILE = os.getenv("EMBED_COMPILE", "false").lower() == "true"
+
+
+class OnnxEncoder:
+    """
+    Drop-in for SentenceTransformer.encode backed by a dynamically quantized
+    (INT8) ONNX model: HF tokenizer, length-sorted batches padded to the
+    longest member, then mean pooling (+ optional L2 norm) in NumPy.
+    """
+
+    MAX_SEQ_LENGTH = 256
+
+    def __init__(self, model_dir: str):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        model_dir = Path(model_dir)
+        quantized = model_dir / "model_int8.onnx"
+        if not quantized.exists():
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            # Quantize to a private path and rename into place, so another worker
+            # starting at the same time never loads a half-written model
+            tmp = model_dir / f"model_int8.{os.getpid()}.onnx.tmp"
+            try:
+                quantize_dynamic(
+                    str(model_dir / "model.onnx"), str(tmp), weight_type=QuantType.QInt8
+                )
+                os.replace(tmp, quantized)
+            finally:
+                if tmp.exists():
+                    tmp.unlink()
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = os.cpu_count() or 1
+        self._session = ort.InferenceSession(
+            str(quantized), options, providers=["CPUExecutionProvider"]
+        )
+        self._input_names = {i.name for i in self._session.get_inputs()}
+        self._tokenizer = AutoTokenizer.from_pretrained(str(model_dir))
+        self._dim = self._session.get_outputs()[0].shape[-1]
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self._dim
+
+    def encode(
+        self,
+        sentences: Union[str, List[str]],
+        batch_size: int = 32,
+        convert_to_numpy: bool = True,
+        normalize_embeddings: bool = False,
+        show_progress_bar: bool = False,
+    ) -> np.ndarray:
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        out = np.empty((len(texts), self._dim), dtype=np.float32)
+
+        order = np.argsort([-len(t) for t in texts], kind="stable")
+        for start in range(0, len(texts), batch_size):
+            idx = order[start : start + batch_size]
+            tokens = self._tokenizer(
+                [texts[i] for i in idx],
+                padding="longest",
+                truncation=True,
+                max_length=self.MAX_SEQ_LENGTH,
+                return_tensors="np",
+            )
+            feeds = {k: v.astype(np.int64) for k, v in tokens.items() if k in self._input_names}
+            hidden = self._session.run(None, feeds)[0]
+            mask = tokens["attention_mask"].astype(np.float32)
+            # Masked sum in one contraction, without a (B, T, D) temporary
+            summed = np.einsum("btd,bt->bd", hidden, mask)
+            out[idx] = summed / np.clip(mask.sum(axis=1, keepdims=True), 1e-9, None)
+
+        if normalize_embeddings:
+            faiss.normalize_L2(out)
+        return out[0] if single else out
+
+
+if EMBED_ONNX_DIR:
+    _MODEL = OnnxEncoder(EMBED_ONNX_DIR)
+    _inference = nullcontext
+else:
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    # Let the encoder's matmuls use every core instead of torch's conservative default
+    torch.set_num_threads(os.cpu_count() or 1)
+    _MODEL = SentenceTransformer(
+        "all-MiniLM-L6-v2", device="cuda" if torch.cuda.is_available() else "cpu"
+    )
+    if EMBED_COMPILE:
+        # Sequence length varies per batch; dynamic shapes avoid a recompile each time
+        _MODEL[0].auto_model = torch.compile(_MODEL[0].auto_model, dynamic=True)
+
+    @contextmanager
+    def _inference():
+        # No autograd bookkeeping for pure inference; optionally autocast matmuls
+        device_type = _MODEL.device.type
+        dtype = torch.float16 if device_type == "cuda" else torch.bfloat16
+        with torch.inference_mode(), torch.autocast(
+            device_type=device_type, dtype=dtype, enabled=EMBED_AUTOCAST
+        ):
+            yield
+_DIM = _MODEL.get_sentence_embedding_dimension()
+
+# With faiss-gpu installed and a GPU visible, fp32 flat indexes are searched
+# through a device-resident mirror. One resources object per process; FAISS
+# GPU resources must not be used from several threads at once.
+_GPU_RES = (
+    faiss.StandardGpuResources()
+    if hasattr(faiss, "StandardGpuResources") and faiss.get_num_gpus() > 0
+    else None
+)
+_GPU_LOCK = threading.Lock()
+
+# Storage precision of the per-user flat index: fp32 (exact), fp16 (half the
+# bytes streamed per query, negligible loss for MiniLM) or int8 (a quarter).
+# Large stores additionally get the IVF-PQ index below regardless.
+MEMORY_QUANTIZE = os.getenv("MEMORY_QUANTIZE", "fp32").lower()
+if MEMORY_QUANTIZE not in {"fp32", "fp16", "int8"}:
+    raise RuntimeError(f"Unsupported MEMORY_QUANTIZE: {MEMORY_QUANTIZE}")
+
+# Per-component range of the int8 codes. Unit-length 384-d MiniLM embeddings
+# have components with std ~0.05 and rarely beyond ±0.25, so [-1, 1] would
+# leave most of the 256 levels unused; the rare component past this is clipped.
+INT8_RANGE = 0.3
+
+
+def _new_flat_index():
+    if MEMORY_QUANTIZE == "fp16":
+        return faiss.IndexScalarQuantizer(
+            _DIM, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT
+        )
+    if MEMORY_QUANTIZE == "int8":
+        index = faiss.IndexScalarQuantizer(
+            _DIM, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT
+        )
+        # Stores grow one memory at a time, so there is no representative first
+        # batch to train on; fix the range instead (saved with the index)
+        index.train(np.array([[-INT8_RANGE] * _DIM, [INT8_RANGE] * _DIM], dtype=np.float32))
+        return index
+    return faiss.IndexFlatIP(_DIM)
+
+
+# Stores at or above this size are also searched through a trained IVF-PQ
+# index; below it the PQ codebooks (256 centroids each) are undertrained and
+# the exact flat scan is cheap anyway. PQ distances alone are too coarse to
+# rank (recall@3 ~0.3-0.5 on 384-d data), so the index only proposes
+# ANN_CANDIDATES ids, which are re-scored exactly against the flat index.
+ANN_MIN_SIZE = 10_000
+ANN_TRAIN_SIZE = 10_000
+ANN_NPROBE = 64
+ANN_PQ_M = 32
+ANN_CANDIDATES = 100
+# A freshly built index is only used if its re-ranked top-k recall against
+# the flat index, on a sample of perturbed stored vectors, is at least this
+ANN_MIN_RECALL = 0.9
+ANN_RECALL_SAMPLES = 64
+
+# Training takes tens of seconds at ANN_MIN_SIZE, so it runs here rather than
+# in the request that crossed the threshold; one at a time keeps it from
+# competing with itself for cores.
+_ANN_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ann-train")
+
+
+# Byte offset of ntotal in FAISS's index header (after the fourcc and int32 d)
+_NTOTAL_OFFSET = 8
+
+
+def build_ann_index(vectors: np.ndarray):
+    """
+    Train an IVF-PQ inner-product index on the first ANN_TRAIN_SIZE of
+    `vectors` (normalized, float32) and add all of them, so ids match row positions.
+    """
+    train = vectors[:ANN_TRAIN_SIZE]
+    # ~39 training points per IVF list keeps k-means stable; cap at 1024 lists
+    nlist = max(1, min(1024, len(train) // 39))
+    index = faiss.index_factory(
+        vectors.shape[1], f"IVF{nlist},PQ{ANN_PQ_M}", faiss.METRIC_INNER_PRODUCT
+    )
+    index.train(train)
+    index.add(vectors)
+    faiss.extract_index_ivf(index).nprobe = ANN_NPROBE
+    return index
 
 
 class MemoryStore:
+    """
+    `texts[i]` pairs with vector i of a flat FAISS index (IndexFlatIP, or a
+    scalar-quantized one per MEMORY_QUANTIZE) holding L2-normalized
+    embeddings, so inner-product search is cosine similarity and a
+    query is one GEMV plus a top-k heap selection inside FAISS. Large stores
+    additionally keep a compressed IVF-PQ index that proposes candidates for
+    an exact re-rank against the flat index. The add() that crosses
+    ANN_MIN_SIZE starts training it on a background thread over a snapshot
+    of the vectors; until it is ready queries use the exact flat index, and
+    the next add/query installs it, catches it up, and checks its recall
+    (a build below ANN_MIN_RECALL is discarded and flat search is kept).
+    Once installed it is kept (and persisted) across adds and removes, and
+    only dropped by clear/load.
+
+    Not thread-safe: callers serialize access per store. The training thread
+    only touches its own snapshot.
+    """
+
     def __init__(self):
         self.model = _MODEL
-        self.texts = []
-        self.embeddings = []
+        self.texts: List[str] = []
+        self.index = _new_flat_index()
+        self._mapped = False  # index storage is a read-only mmap of a saved file
+        self._ann = None
+        self._ann_future = None  # pending background build of self._ann
+        self._ann_removed = False  # a remove() happened since that build started
+        self._ann_rejected = False  # a build failed the recall check; don't rebuild
+        self._gpu = None  # GPU mirror of self.index, built on first query
+        # File written by save_index/mapped by load_file whose rows are exactly
+        # the first _index_file_rows rows of self.index, so it can be appended to
+        self.index_file: Optional[str] = None
+        self._index_file_rows = 0
+
+    @property
+    def embeddings(self) -> np.ndarray:
+        """
+        (N, D) float32 embeddings. For fp32 storage this is a view of the flat
+        index's contiguous storage, without copying, only valid until the next
+        add/remove/clear; quantized storage is decoded into a new array.
+        """
+        n = self.index.ntotal
+        if n == 0:
+            return np.empty((0, _DIM), dtype=np.float32)
+        if isinstance(self.index, faiss.IndexFlat):
+            return faiss.rev_swig_ptr(self.index.get_xb(), n * _DIM).reshape(n, _DIM)
+        return self.index.reconstruct_n(0, n)
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        with _inference():
+            emb = self.model.encode(
+                texts,
+                batch_size=ENCODE_BATCH_SIZE,
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+                show_progress_bar=False,
+            )
+        return np.ascontiguousarray(emb, dtype=np.float32).reshape(len(texts), _DIM)
+
+    def _own(self):
+        # A memory-mapped index can't grow or shrink in place; take a private
+        # in-RAM copy (serialize/deserialize always allocates) before mutating
+        if self._mapped:
+            self.index = faiss.deserialize_index(faiss.serialize_index(self.index))
+            self._mapped = False
+
+    def _start_ann_build(self):
+        # Copy: the embeddings view is invalidated by the next add/remove
+        snapshot = np.array(self.embeddings, dtype=np.float32)
+        self._ann_future = _ANN_EXECUTOR.submit(build_ann_index, snapshot)
+        self._ann_removed = False
+
+    def _install_ann(self):
+        """
+        Adopt a finished background build, adding the vectors that arrived
+        since its snapshot (or re-adding all of them after a remove).
+        """
+        future = self._ann_future
+        if future is None or not future.done():
+            return
+        self._ann_future = None
+        try:
+            ann = future.result()
+        except Exception as e:
+            print(f"Error building ANN index: {e}")
+            return
+        if self._ann_removed:
+            ann.reset()
+            ann.add(self.embeddings)
+        elif ann.ntotal < self.index.ntotal:
+            ann.add(self.embeddings[ann.ntotal :])
+        recall = self._ann_recall(ann)
+        if recall < ANN_MIN_RECALL:
+            print(f"ANN index recall {recall:.2f} < {ANN_MIN_RECALL}; keeping flat search")
+            self._ann_rejected = True
+            return
+        self._ann = ann
+
+    def _ann_search(self, ann, queries: np.ndarray, k: int) -> np.ndarray:
+        """
+        Top-k ids per query: ANN_CANDIDATES proposed by `ann`, re-scored by
+        exact inner product against the flat index. Padded with -1.
+        """
+        n_cand = min(max(k, ANN_CANDIDATES), self.index.ntotal)
+        _, candidates = ann.search(queries, n_cand)
+        out = np.full((len(queries), k), -1, dtype=np.int64)
+        for row, (query, ids) in enumerate(zip(queries, candidates)):
+            ids = ids[ids != -1]
+            scores = self.index.reconstruct_batch(ids) @ query
+            top = ids[np.argsort(-scores)[:k]]
+            out[row, : len(top)] = top
+        return out
+
+    def _ann_recall(self, ann, k: int = 5) -> float:
+        # Queries near, but not on, stored vectors: each sample plus noise of
+        # about its own norm, renormalized
+        n = self.index.ntotal
+        rng = np.random.default_rng(0)
+        ids = rng.choice(n, size=min(ANN_RECALL_SAMPLES, n), replace=False)
+        queries = self.index.reconstruct_batch(ids)
+        queries += rng.normal(scale=_DIM ** -0.5, size=queries.shape).astype(np.float32)
+        faiss.normalize_L2(queries)
+        k = min(k, n)
+        _, exact = self.index.search(queries, k)
+        approx = self._ann_search(ann, queries, k)
+        hits = sum(len(set(e) & set(a)) for e, a in zip(exact, approx))
+        return hits / (len(queries) * k)
 
     def add(self, texts: List[str]):
-        embeddings = self.model.encode(texts, convert_to_tensor=True)
+        if not texts:
+            return
+        embeddings = self._encode(texts)
+        self._install_ann()
+        self._own()
+        self.index.add(embeddings)
+        if self._gpu is not None:
+            with _GPU_LOCK:
+                self._gpu.add(embeddings)
+        if self._ann is not None:
+            self._ann.add(embeddings)
+        elif (
+            self._ann_future is None
+            and not self._ann_rejected
+            and self.index.ntotal >= ANN_MIN_SIZE
+        ):
+            self._start_ann_build()
         self.texts.extend(texts)
-        self.embeddings.extend([emb for emb in embeddings]) 
 
-    def query(self, text: str, top_k: int = 5) -> List[str]:
-        if not self.embeddings:
-            return []
+    def remove(self, index: int):
+        """
+        Delete one entry; supports negative indices and raises IndexError like list del.
+        """
+        if index < 0:
+            index += len(self.texts)
+        if not 0 <= index < len(self.texts):
+            raise IndexError("memory index out of range")
+        del self.texts[index]
+        self._own()
+        # Flat indexes compact on removal, so ids keep matching positions in texts
+        self.index.remove_ids(faiss.IDSelectorRange(index, index + 1))
+        self.index_file = None
+        if self._ann is not None:
+            # IVF ids don't compact; re-add under the trained quantizer/codebooks
+            # rather than retraining
+            self._ann.reset()
+            self._ann.add(self.embeddings)
+        self._ann_removed = True
+        self._gpu = None
+
+    def clear(self):
+        self.texts.clear()
+        self.index = _new_flat_index()
+        self._mapped = False
+        self._ann = None
+        self._ann_future = None  # a pending build was over the old contents
+        self._ann_rejected = False
+        self._gpu = None
+        self.index_file = None
+
+    def load(self, texts: List[str], embeddings: Sequence, normalized: bool = False):
+        """
+        Replace the store contents with already-computed embeddings
+        (an (N, D) array, or a list of per-row vectors/tensors). Pass
+        normalized=True for vectors this store wrote, which are unit-length
+        already, to skip the normalization pass.
+        """
+        self.clear()
+        if len(texts) == 0:
+            return
+        if isinstance(embeddings, np.ndarray):
+            rows = embeddings
+        else:
+            rows = [
+                row.detach().cpu().numpy() if hasattr(row, "detach") else row
+                for row in embeddings
+            ]
+        matrix = np.ascontiguousarray(rows, dtype=np.float32).reshape(len(texts), _DIM)
+        if not normalized:
+            faiss.normalize_L2(matrix)
+        self.index.add(matrix)
+        self.texts = list(texts)
+
+    def save_index(self, f):
+        """
+        Write the flat index in FAISS's native format, which load_file can
+        memory-map back (fp16/int8 storage stays fp16/int8 on disk).
+        """
+        faiss.write_index(self.index, faiss.PyCallbackIOWriter(f.write))
 
-        embedding_tensor = torch.stack(self.embeddings) if self.embeddings else torch.empty(0)
+    def bind_index_file(self, path: str):
+        """
+        Record that `path` now holds exactly this index (e.g. save_index just
+        wrote it), making it the target of append_index.
+        """
+        self.index_file = path
+        self._index_file_rows = self.index.ntotal
 
+    def append_index(self) -> bool:
+        """
+        Extend index_file in place with the rows added since it was written:
+        the new codes go at the end, then the two row counts in the file are
+        bumped. Returns False, leaving the file as it was, when that isn't
+        possible (rows were removed since, no bound file, the file changed
+        under us, or no fcntl); the caller then writes a new file instead.
 
-        query_embedding = self.model.encode(text, convert_to_tensor=True)
-        similarities = util.pytorch_cos_sim(query_embedding, embedding_tensor)[0]
-        top_indices = np.argsort(-similarities.cpu().numpy())[:top_k]
+        Readers that already mapped the file keep seeing their old prefix. A
+        reader opening it mid-append gets a count mismatch and re-reads.
+        """
+        path, start = self.index_file, self._index_file_rows
+        n = self.index.ntotal
+        if path is None or fcntl is None or n < start:
+            return False
+        if n == start:
+            return True
+        code_size = self.index.code_size
+        codes = faiss.rev_swig_ptr(self.index.codes.data(), n * code_size)
+        # Flat indexes record their code length in floats, others in bytes
+        unit = 4 if isinstance(self.index, faiss.IndexFlat) else 1
+        try:
+            with open(path, "r+b") as f:
+                # Serialize appenders across workers; a stale view of the file fails the checks below
+                fcntl.flock(f, fcntl.LOCK_EX)
+                end = f.seek(0, os.SEEK_END)
+                size_at = end - start * code_size - 8
+                if size_at < _NTOTAL_OFFSET + 8:
+                    return False
+                f.seek(_NTOTAL_OFFSET)
+                (ntotal,) = struct.unpack("<q", f.read(8))
+                f.seek(size_at)
+                (size,) = struct.unpack("<Q", f.read(8))
+                if ntotal != start or size != start * code_size // unit:
+                    return False
+                f.seek(end)
+                f.write(codes[start * code_size :].tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+                f.seek(size_at)
+                f.write(struct.pack("<Q", n * code_size // unit))
+                f.seek(_NTOTAL_OFFSET)
+                f.write(struct.pack("<q", n))
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError:
+            return False
+        self._index_file_rows = n
+        return True
+
+    def save(self, f, index_file: Optional[str] = None):
+        """
+        Write texts as an .npz (stored as UTF-8 JSON bytes), plus the trained
+        IVF-PQ index when there is one so it isn't retrained on load. Vectors go
+        inline as `embeddings`, or, when `index_file` names a file written by
+        save_index, only that name is recorded.
+        """
+        texts_blob = np.frombuffer(orjson.dumps(self.texts), dtype=np.uint8)
+        arrays = {"texts": texts_blob}
+        if index_file is not None:
+            arrays["index_file"] = np.frombuffer(index_file.encode("utf-8"), dtype=np.uint8)
+        else:
+            arrays["embeddings"] = self.embeddings
+        if self._ann is not None:
+            arrays["ann"] = faiss.serialize_index(self._ann)
+        np.savez(f, **arrays)
+
+    def _map_index(self, texts: List[str], path: str):
+        # Page vectors in on demand instead of reading and copying them all up front
+        index = faiss.read_index(path, faiss.IO_FLAG_MMAP_IFC)
+        if index.ntotal != len(texts):
+            raise ValueError(f"{path} holds {index.ntotal} vectors for {len(texts)} texts")
+        if type(index) is not type(self.index):
+            # Saved under a different MEMORY_QUANTIZE; re-encode into the current one
+            vectors = index.reconstruct_n(0, index.ntotal) if index.ntotal else []
+            self.load(texts, vectors, normalized=True)
+            return
+        self.clear()
+        self.index = index
+        self._mapped = True
+        self.texts = list(texts)
+        self.bind_index_file(path)
+
+    def load_file(self, f, index_dir: Optional[str] = None):
+        """
+        Load a file written by save(); an `index_file` reference is resolved
+        against `index_dir` and memory-mapped.
+        """
+        with np.load(f) as data:
+            texts = orjson.loads(data["texts"].tobytes())
+            if "index_file" in data.files and index_dir is not None:
+                name = data["index_file"].tobytes().decode("utf-8")
+                self._map_index(texts, os.path.join(index_dir, name))
+            else:
+                self.load(texts, data["embeddings"], normalized=True)
+            if "ann" in data.files:
+                ann = faiss.deserialize_index(data["ann"])
+                if ann.ntotal == self.index.ntotal:
+                    faiss.extract_index_ivf(ann).nprobe = ANN_NPROBE
+                    self._ann = ann
+
+    def query(self, text: str, top_k: int = 5) -> List[str]:
+        if self.index.ntotal == 0:
+            return []
 
-        return [self.texts[i] for i in top_indices]
-    
+        query_embedding = self._encode([text])
+        self._install_ann()
+        k = min(top_k, self.index.ntotal)
+        if self._ann is not None:
+            indices = self._ann_search(self._ann, query_embedding, k)
+        elif _GPU_RES is not None and isinstance(self.index, faiss.IndexFlat):
+            with _GPU_LOCK:
+                if self._gpu is None:
+                    self._gpu = faiss.index_cpu_to_gpu(_GPU_RES, 0, self.index)
+                # Only the (1, k) ids come back from the device
+                _, indices = self._gpu.search(query_embedding, k)
+        else:
+            _, indices = self.index.search(query_embedding, k)
+        return [self.texts[i] for i in indices[0] if i != -1]
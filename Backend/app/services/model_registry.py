@@ -1,7 +1,8 @@
 from __future__ import annotations
 
 import os
-from typing import List, Optional
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
 
 from dotenv import load_dotenv
 
@@ -33,24 +34,26 @@ if _TOGETHER_ENV_MODELS:
             )
 
 
-def _provider_enabled(provider: str) -> bool:
-    provider = provider.lower()
-    if provider == "openai":
-        return bool(os.getenv("OPENAI_API_KEY"))
-    if provider == "anthropic":
-        return bool(os.getenv("ANTHROPIC_API_KEY"))
-    if provider == "deepseek":
-        return bool(os.getenv("DEEPSEEK_API_KEY"))
-    if provider == "together":
-        return bool(os.getenv("TOGETHER_API_KEY"))
-    return False
+# Availability depends only on process env and the catalog, so it is
+# resolved once at import rather than on every lookup.
+_ENABLED = frozenset(
+    provider
+    for provider in ("openai", "anthropic", "deepseek", "together")
+    if os.getenv(f"{provider.upper()}_API_KEY")
+)
+_AVAILABLE: Tuple[ModelSpec, ...] = tuple(spec for spec in _CATALOG if spec.provider in _ENABLED)
+_BY_KEY: Dict[Tuple[str, str], ModelSpec] = {}
+for _spec in _AVAILABLE:
+    _BY_KEY.setdefault((_spec.provider, _spec.model), _spec)
 
 
-def list_available_models() -> List[ModelSpec]:
-    return [spec for spec in _CATALOG if _provider_enabled(spec.provider)]
+def list_available_models() -> Tuple[ModelSpec, ...]:
+    return _AVAILABLE
 
 
+@lru_cache(maxsize=1)
 def resolve_default_model() -> Optional[ModelSpec]:
+    # Depends only on process env/catalog, so it is computed once.
     preferred_provider = os.getenv("DEFAULT_LLM_PROVIDER")
     preferred_model = os.getenv("DEFAULT_LLM_MODEL")
     if preferred_provider:
@@ -66,7 +69,4 @@ def resolve_default_model() -> Optional[ModelSpec]:
 
 
 def lookup_model(provider: str, model: str) -> Optional[ModelSpec]:
-    for spec in list_available_models():
-        if spec.provider == provider and spec.model == model:
-            return spec
-    return None
+    return _BY_KEY.get((provider, model))
@@ -1,42 +1,129 @@
 # app/services/rag.py
 
-import re
+import asyncio
 import os
-from typing import List, Optional
-from openai import OpenAI
+import hashlib
+import io
+import random
+import re
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+import numpy as np
+import orjson
+import tiktoken
+from openai import (
+    APIConnectionError,
+    APITimeoutError,
+    AsyncOpenAI,
+    InternalServerError,
+    OpenAI,
+    RateLimitError,
+)
 
 # ──────────────────────────────────────────────────────────────────────────────
-# 1) Basic text‐chunking logic (approximate 500-word chunks with 50-word overlap)
+# 1) Token-window chunking (400-token chunks with 50-token overlap)
 # ──────────────────────────────────────────────────────────────────────────────
 
-CHUNK_SIZE = 500
+CHUNK_SIZE = 400    # tokens of the embedding model's tokenizer
 OVERLAP_SIZE = 50
 
+@lru_cache(maxsize=1)
+def _encoding() -> "tiktoken.Encoding":
+    # Loaded on first use: tiktoken fetches/caches the BPE ranks on first load
+    return tiktoken.encoding_for_model(EMBED_MODEL)
+
+
+def _windows(ids: List[int]) -> List[List[int]]:
+    step = CHUNK_SIZE - OVERLAP_SIZE
+    return [ids[start : start + CHUNK_SIZE] for start in range(0, len(ids), step)]
+
+
 def chunk_text(text: str) -> list[str]:
     """
-    Split a large string into smaller chunks of ~CHUNK_SIZE words,
-    overlapping by ~OVERLAP_SIZE words between consecutive chunks.
+    Split a large string into chunks of CHUNK_SIZE tokens (as counted by the
+    embedding model's tokenizer), overlapping by OVERLAP_SIZE tokens, so each
+    chunk is exactly embedding-sized. Tokenization runs in tiktoken's Rust core.
+    """
+    enc = _encoding()
+    ids = enc.encode_ordinary(text)
+    if len(ids) <= CHUNK_SIZE:
+        return [text.strip()] if text.strip() else []
+    return [enc.decode(window) for window in _windows(ids)]
+
+
+# The last whitespace run and the word after it, ending the text
+_TRAILING_WORD = re.compile(r"\s+\S*\Z")
+
+
+class StreamingChunker:
     """
-    # Normalize whitespace
-    text = re.sub(r"\s+", " ", text).strip()
-    words = text.split(" ")
-    if len(words) <= CHUNK_SIZE:
-        return [text]
+    Incremental version of chunk_text: feed decoded text piece by piece and
+    get back the same token windows, without holding the whole document in
+    memory. Pieces are cut just before a whitespace run, where tiktoken's
+    pre-tokenizer splits anyway, so seams rarely change the tokenization.
+    The carried-over tail is capped at TAIL_MAX characters: text with no
+    whitespace (base64, minified JSON) is cut mid-word rather than buffered.
+    """
+
+    TAIL_MAX = 4096
+
+    def __init__(self) -> None:
+        self._ids: list[int] = []
+        self._tail = ""  # text after the last word boundary, carried between feeds
+        self._emitted = False
+
+    def _drain(self) -> list[str]:
+        # Emit every window that is guaranteed not to be the last one,
+        # keeping the overlap (and anything shorter) buffered.
+        enc = _encoding()
+        chunks: list[str] = []
+        start = 0
+        step = CHUNK_SIZE - OVERLAP_SIZE
+        while len(self._ids) - start > CHUNK_SIZE:
+            chunks.append(enc.decode(self._ids[start : start + CHUNK_SIZE]))
+            start += step
+        if start:
+            del self._ids[:start]
+            self._emitted = True
+        return chunks
 
-    chunks: list[str] = []
-    start = 0
-    while start < len(words):
-        end = min(start + CHUNK_SIZE, len(words))
-        chunk = " ".join(words[start:end])
-        chunks.append(chunk)
-        # Move start forward but leave overlap
-        start += CHUNK_SIZE - OVERLAP_SIZE
+    def feed(self, text: str) -> list[str]:
+        text = self._tail + text
+        # Cut before the last whitespace run, looking only as far back as the cap
+        match = _TRAILING_WORD.search(text, max(0, len(text) - self.TAIL_MAX))
+        if match:
+            cut = match.start()
+        else:
+            cut = len(text) if len(text) > self.TAIL_MAX else 0
+        self._tail = text[cut:]
+        if cut:
+            self._ids.extend(_encoding().encode_ordinary(text[:cut]))
+        return self._drain()
 
-    return chunks
+    def finish(self) -> list[str]:
+        if self._tail:
+            self._ids.extend(_encoding().encode_ordinary(self._tail))
+            self._tail = ""
+        chunks = self._drain()
+        if not self._ids:
+            return chunks
+        enc = _encoding()
+        if not self._emitted:
+            text = enc.decode(self._ids).strip()
+            if text:
+                chunks.append(text)
+        else:
+            chunks.extend(enc.decode(window) for window in _windows(self._ids))
+        self._ids = []
+        return chunks
 
 
 # ──────────────────────────────────────────────────────────────────────────────
-# 2) OpenAI embedding calls via the new v1 Python client (synchronous)
+# 2) OpenAI embedding calls via the new v1 Python client (sync + async)
 # ──────────────────────────────────────────────────────────────────────────────
 
 # Instantiate a single OpenAI client for use across calls
@@ -54,34 +141,237 @@ def get_openai_client() -> OpenAI:
         _client = OpenAI(api_key=openai_api_key)
     return _client
 
+_async_client: Optional[AsyncOpenAI] = None
+
+def _new_async_openai_client() -> AsyncOpenAI:
+    openai_api_key = os.getenv("OPENAI_API_KEY")
+    if not openai_api_key:
+        raise RuntimeError("OPENAI_API_KEY is not set")
+    # Retries are handled in _embed_batch so backoff is applied exactly once
+    return AsyncOpenAI(api_key=openai_api_key, max_retries=0)
+
+
+def get_async_openai_client() -> AsyncOpenAI:
+    """
+    Return a singleton AsyncOpenAI client, for use from the server's event loop.
+    """
+    global _async_client
+    if _async_client is None:
+        _async_client = _new_async_openai_client()
+    return _async_client
+
 EMBED_MODEL = "text-embedding-ada-002"
 
 
+# ──────────────────────────────────────────────────────────────────────────────
+# Content-hash embedding cache (SQLite), so re-ingesting unchanged text is free
+# ──────────────────────────────────────────────────────────────────────────────
+
+# Shared by every worker. Entries are never evicted (~6 KB per distinct chunk
+# for 1536-d vectors), so the file grows with everything ever ingested; it is
+# only a cache and can be deleted at any time while the server is stopped.
+# Cache failures are logged and otherwise ignored: they must not fail an
+# ingest whose embeddings are already paid for.
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", "embedding_cache.sqlite3")
+EMBED_CACHE_TIMEOUT = 10.0  # seconds to wait on another worker's write lock
+_cache_conn: Optional[sqlite3.Connection] = None
+_cache_lock = threading.Lock()
+
+
+def _content_hash(text: str) -> str:
+    return hashlib.sha256(f"{EMBED_MODEL}\0{text}".encode("utf-8")).hexdigest()
+
+
+def _cache() -> sqlite3.Connection:
+    global _cache_conn
+    if _cache_conn is None:
+        conn = sqlite3.connect(
+            EMBED_CACHE_PATH, timeout=EMBED_CACHE_TIMEOUT, check_same_thread=False
+        )
+        # WAL lets readers in other workers proceed while one worker writes
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (hash TEXT PRIMARY KEY, vector BLOB NOT NULL)"
+        )
+        _cache_conn = conn
+    return _cache_conn
+
+
+def _cache_get(hashes: List[str]) -> Dict[str, list[float]]:
+    found: Dict[str, list[float]] = {}
+    with _cache_lock:
+        try:
+            conn = _cache()
+            for i in range(0, len(hashes), 500):  # stay under SQLite's bound-parameter limit
+                part = hashes[i : i + 500]
+                rows = conn.execute(
+                    f"SELECT hash, vector FROM embeddings WHERE hash IN ({','.join('?' * len(part))})",
+                    part,
+                )
+                for h, blob in rows:
+                    found[h] = np.frombuffer(blob, dtype=np.float32).tolist()
+        except sqlite3.Error as e:
+            print(f"Error reading embedding cache: {e}")
+    return found
+
+
+def _cache_put(items: Dict[str, list[float]]) -> None:
+    if not items:
+        return
+    rows = [(h, np.asarray(v, dtype=np.float32).tobytes()) for h, v in items.items()]
+    with _cache_lock:
+        try:
+            conn = _cache()
+            with conn:  # commit, or roll back so the connection stays usable
+                conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings (hash, vector) VALUES (?, ?)", rows
+                )
+        except sqlite3.Error as e:
+            print(f"Error writing embedding cache: {e}")
+
+
+EMBED_BATCH_SIZE = 50       # chunks per embeddings.create call
+EMBED_CONCURRENCY = 16      # embeddings.create calls in flight at once
+EMBED_MAX_RETRIES = 5       # attempts per batch on a transient error before giving up
+
+# What the SDK's own retries would have covered: 429, 5xx, timeouts, dropped connections
+_RETRYABLE = (RateLimitError, InternalServerError, APITimeoutError, APIConnectionError)
+
+
+async def _embed_batch(client: AsyncOpenAI, texts: List[str]) -> List[list[float]]:
+    for attempt in range(EMBED_MAX_RETRIES):
+        try:
+            resp = await client.embeddings.create(input=texts, model=EMBED_MODEL)
+            # resp.data is a list of objects, each has a .embedding attribute
+            return [item.embedding for item in resp.data]
+        except _RETRYABLE:
+            if attempt == EMBED_MAX_RETRIES - 1:
+                raise
+            # Exponential backoff with jitter: ~1s, 2s, 4s, 8s
+            await asyncio.sleep(2 ** attempt + random.random())
+    raise AssertionError("unreachable")
+
+
+async def aembed_chunks(
+    chunks: List[str], client: Optional[AsyncOpenAI] = None
+) -> List[list[float]]:
+    """
+    Async embed_chunks: cache misses are sent in EMBED_BATCH_SIZE batches with
+    up to EMBED_CONCURRENCY requests in flight (429s, 5xx and connection
+    errors back off and retry);
+    results come back in input order. Chunks already in the content-hash
+    cache are not re-sent.
+    """
+    hashes = [_content_hash(chunk) for chunk in chunks]
+    cached = await asyncio.to_thread(_cache_get, hashes)
+    missing = list(dict.fromkeys(h for h in hashes if h not in cached))
+    if missing:
+        text_by_hash = dict(zip(hashes, chunks))
+        batches = [
+            missing[i : i + EMBED_BATCH_SIZE] for i in range(0, len(missing), EMBED_BATCH_SIZE)
+        ]
+        semaphore = asyncio.Semaphore(EMBED_CONCURRENCY)
+        if client is None:
+            client = get_async_openai_client()
+
+        async def _run(batch: List[str]) -> List[list[float]]:
+            async with semaphore:
+                return await _embed_batch(client, [text_by_hash[h] for h in batch])
+
+        # gather keeps batch order, so results zip back onto their hashes
+        results = await asyncio.gather(*(_run(batch) for batch in batches))
+        fresh: Dict[str, list[float]] = {}
+        for batch, vectors in zip(batches, results):
+            fresh.update(zip(batch, vectors))
+
+        await asyncio.to_thread(_cache_put, fresh)
+        cached.update(fresh)
+
+    return [cached[h] for h in hashes]
+
+
 def embed_chunks(chunks: List[str]) -> List[list[float]]:
     """
-    Given a list of text chunks, call the OpenAI Embeddings API (synchronously)
-    and return a list of embedding vectors (each a list of floats).
+    Given a list of text chunks, call the OpenAI Embeddings API and return a
+    list of embedding vectors (each a list of floats). Blocking wrapper around
+    aembed_chunks for callers without an event loop (e.g. a worker thread).
+    """
+    async def _run() -> List[list[float]]:
+        # A client per call: async clients must not outlive the loop they ran on
+        async with _new_async_openai_client() as client:
+            return await aembed_chunks(chunks, client=client)
+
+    return asyncio.run(_run())
+
+
+BATCH_MAX_REQUESTS = 50_000  # per-batch request limit of the OpenAI Batch API
+BATCH_TERMINAL_STATES = {"completed", "failed", "expired", "cancelled"}
+
+
+def embed_chunks_batch(chunks: List[str], poll_interval: float = 30.0) -> List[list[float]]:
+    """
+    Offline/bulk variant of embed_chunks using the OpenAI Batch API (half the
+    price, separate rate-limit pool, completes within 24h). Blocks while
+    polling, so use it from scripts/jobs, not request handlers. Results go
+    through the same content-hash cache, so re-running on unchanged text is a no-op.
     """
+    hashes = [_content_hash(chunk) for chunk in chunks]
+    cached = _cache_get(hashes)
+    missing = list(dict.fromkeys(h for h in hashes if h not in cached))
+    text_by_hash = dict(zip(hashes, chunks))
     client = get_openai_client()
-    embeddings: list[list[float]] = []
-    batch_size = 50  # send up to 50 chunks per API call
-
-    for i in range(0, len(chunks), batch_size):
-        batch = chunks[i : i + batch_size]
-        resp = client.embeddings.create(
-            input=batch,
-            model=EMBED_MODEL
+
+    for i in range(0, len(missing), BATCH_MAX_REQUESTS):
+        part = missing[i : i + BATCH_MAX_REQUESTS]
+        buf = io.BytesIO()
+        for h in part:
+            buf.write(orjson.dumps({
+                "custom_id": h,
+                "method": "POST",
+                "url": "/v1/embeddings",
+                "body": {"model": EMBED_MODEL, "input": text_by_hash[h]},
+            }, option=orjson.OPT_APPEND_NEWLINE))
+
+        input_file = client.files.create(
+            file=("embeddings.jsonl", buf.getvalue()), purpose="batch"
+        )
+        batch = client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/embeddings",
+            completion_window="24h",
         )
-        # resp.data is a list of objects, each has a .embedding attribute
-        for item in resp.data:
-            embeddings.append(item.embedding)
+        while batch.status not in BATCH_TERMINAL_STATES:
+            time.sleep(poll_interval)
+            batch = client.batches.retrieve(batch.id)
+        if batch.status != "completed" or not batch.output_file_id:
+            raise RuntimeError(f"Embedding batch {batch.id} ended with status {batch.status}")
 
-    return embeddings
+        fresh: Dict[str, list[float]] = {}
+        for line in client.files.content(batch.output_file_id).text.splitlines():
+            if not line:
+                continue
+            result = orjson.loads(line)
+            response = result.get("response") or {}
+            if response.get("status_code") != 200:
+                continue
+            fresh[result["custom_id"]] = response["body"]["data"][0]["embedding"]
 
+        # Keep what succeeded so a retry only resubmits the failures
+        _cache_put(fresh)
+        cached.update(fresh)
+        failed = len(part) - len(fresh)
+        if failed:
+            raise RuntimeError(f"Embedding batch {batch.id}: {failed} requests failed")
 
+    return [cached[h] for h in hashes]
+
+
+@lru_cache(maxsize=4096)
 def embed_query(query: str) -> list[float]:
     """
     Embed a single query string (used at search time) synchronously.
+    Repeated queries (retries, follow-ups) are served from an in-process LRU;
+    the returned list is shared between callers, so don't mutate it.
     """
     client = get_openai_client()
     resp = client.embeddings.create(
@@ -90,6 +380,15 @@ def embed_query(query: str) -> list[float]:
     )
     return resp.data[0].embedding
 
+_RAG_PROMPT_PREFIX = (
+    "You are a helpful assistant. Use the context excerpts below to answer the user’s question as completely as possible.\n"
+    "If some details aren’t covered by the context, you may fill in from your own knowledge to make a thorough, coherent answer.\n\n"
+    "=== Context ===\n"
+)
+_RAG_CONTEXT_SEPARATOR = "\n\n--- Retrieved Context ---\n\n"
+_RAG_PROMPT_QUESTION = "\n\n=== End Context ===\n\nUser’s Question: "
+_RAG_PROMPT_ANSWER = "\nAssistant’s Answer:"
+
 def build_rag_prompt(chunks: list[str], query: str) -> str:
     """
     Assemble a single prompt that:
@@ -100,16 +399,10 @@ def build_rag_prompt(chunks: list[str], query: str) -> str:
 
     You will pass this entire string as one "user" message to ChatGPT.
     """
-    # 1) Join all chunks with clear separators
-    context_block = "\n\n--- Retrieved Context ---\n\n".join(chunks)
-
-    prompt = (
-        "You are a helpful assistant. Use the context excerpts below to answer the user’s question as completely as possible.\n"
-        "If some details aren’t covered by the context, you may fill in from your own knowledge to make a thorough, coherent answer.\n\n"
-        "=== Context ===\n"
-        f"{context_block}\n\n"
-        "=== End Context ===\n\n"
-        f"User’s Question: {query}\n"
-        "Assistant’s Answer:"
-    )
-    return prompt
+    return "".join([
+        _RAG_PROMPT_PREFIX,
+        _RAG_CONTEXT_SEPARATOR.join(chunks),
+        _RAG_PROMPT_QUESTION,
+        query,
+        _RAG_PROMPT_ANSWER,
+    ])
@@ -4,15 +4,45 @@ from openai import OpenAI
 
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
+MODEL = "gpt-4-turbo"
+MESSAGES = [{"role": "user", "content": "Hello"}]
+
+def connect():
+    # The first request pays DNS + TLS + HTTP/2 setup; a cheap GET isolates that
+    t0 = time.perf_counter()
+    client.models.list()
+    return time.perf_counter() - t0
+
+def warm_up():
+    # A 1-token completion so the timed request doesn't include first-call costs
+    client.chat.completions.create(model=MODEL, messages=MESSAGES, max_tokens=1)
+
 def test_simple_prompt():
-    t0 = time.time()
-    resp = client.chat.completions.create(
-        model="gpt-4-turbo",
-        messages=[{"role": "user", "content": "Hello"}],
-        temperature=0.0
+    connect_time = connect()
+    warm_up()
+
+    t0 = time.perf_counter()
+    ttft = None
+    parts = []
+    stream = client.chat.completions.create(
+        model=MODEL,
+        messages=MESSAGES,
+        temperature=0.0,
+        max_tokens=16,
+        stream=True,
     )
-    print("Response:", resp.choices[0].message.content)
-    print(f"Took {time.time()-t0:.3f} seconds")
+    for chunk in stream:
+        # The first chunk may carry only the role; time the first actual text
+        if chunk.choices and chunk.choices[0].delta.content:
+            if ttft is None:
+                ttft = time.perf_counter() - t0
+            parts.append(chunk.choices[0].delta.content)
+    total = time.perf_counter() - t0
+
+    print("Response:", "".join(parts))
+    print(f"Connect:           {connect_time:.3f} seconds")
+    print(f"TTFT:              {ttft if ttft is not None else float('nan'):.3f} seconds")
+    print(f"Full response:     {total:.3f} seconds")
 
 if __name__ == "__main__":
     test_simple_prompt()
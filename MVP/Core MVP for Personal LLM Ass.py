@@ -15,6 +15,7 @@ client = OpenAI(api_key=api_key)
 
 # === 0. Imports ===
 import faiss
+import io
 import json
 import streamlit as st
 from typing import List
@@ -22,6 +23,9 @@ from PyPDF2 import PdfReader
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sentence_transformers import SentenceTransformer
 import numpy as np
+import torch
+
+torch.set_num_threads(os.cpu_count() or 1)  # use every core for local embedding
 
 # === 1. Config ===
 @st.cache_resource(show_spinner="Loading embedding model...")
@@ -35,27 +39,59 @@ openai.api_key = os.getenv("OPENAI_API_KEY")
 #embed_model = SentenceTransformer('all-MiniLM-L6-v2')  # Local embeddings
 index = faiss.IndexFlatL2(384)  # Vector size for MiniLM
 chunk_store = []  # To keep text chunks with metadata
+corpus_key = 0  # Fingerprint of everything embedded into index during this run
 uploaded_files_meta = []  # To track filenames and number of chunks
 
 # === 2. Document Ingestion ===
+def chunk_words(text, chunk_size=500):
+    # str.split() with no argument splits on whitespace runs in one C pass,
+    # so no separate normalization step is needed
+    words = text.split()
+    return [" ".join(words[i:i+chunk_size]) for i in range(0, len(words), chunk_size)]
+
 def load_and_chunk_pdf(path, chunk_size=500):
     reader = PdfReader(path)
-    raw_text = " ".join([page.extract_text() or '' for page in reader.pages])
-    words = raw_text.split()
-    return [" ".join(words[i:i+chunk_size]) for i in range(0, len(words), chunk_size)]
+    # Stream page text into one buffer instead of building a list of pages first
+    buf = io.StringIO()
+    for page in reader.pages:
+        buf.write(page.extract_text() or '')
+        buf.write(" ")
+    return chunk_words(buf.getvalue(), chunk_size)
 
 def embed_chunks(chunks: List[str]):
-    embeddings = embed_model.encode(chunks)
+    global corpus_key
+    embeddings = embed_model.encode(
+        chunks,
+        batch_size=1024,
+        convert_to_numpy=True,
+        normalize_embeddings=True,
+        show_progress_bar=False,
+    )
     index.add(np.array(embeddings, dtype=np.float32))
     chunk_store.extend(chunks)
+    # Same chunks on a rerun give the same key, so cached retrievals stay valid
+    corpus_key = hash((corpus_key, tuple(chunks)))
 
 # === 3. Retrieval ===
 def retrieve_relevant_chunks(query, k=5):
     if not chunk_store or index.ntotal == 0:
         return []  # No memory available yet
-    query_vec = embed_model.encode([query]).astype('float32')
-    D, I = index.search(query_vec, k)
-    return [chunk_store[i] for i in I[0] if i < len(chunk_store)]
+    # Streamlit reruns the script on every interaction; skip re-embedding and
+    # re-searching a query we already answered against the same contents.
+    # The cache outlives the rerun but index/chunk_store don't, so key on
+    # what was embedded rather than on how many chunks there are.
+    cache = st.session_state.retrieval_cache
+    key = (query, k, corpus_key)
+    if key in cache:
+        return cache[key]
+    query_vec = embed_model.encode(
+        [query], convert_to_numpy=True, normalize_embeddings=True, show_progress_bar=False
+    ).astype('float32')
+    # FAISS does the partial top-k selection; ask for no more than exist and
+    # skip -1 padding (which would otherwise index chunk_store[-1])
+    D, I = index.search(query_vec, min(k, index.ntotal))
+    cache[key] = [chunk_store[i] for i in I[0] if 0 <= i < len(chunk_store)]
+    return cache[key]
 
 # === 4. Prompt Construction ===
 def build_prompt(query, memory_chunks):
@@ -84,6 +120,8 @@ st.title("📚 Personal AI with Local Memory")
 if "uploaded_files_meta" not in st.session_state:
     st.session_state.uploaded_files_meta = []
 uploaded_files_meta = st.session_state.uploaded_files_meta
+if "retrieval_cache" not in st.session_state:
+    st.session_state.retrieval_cache = {}
 
 # Memory Browser
 with st.expander("🧠 View Uploaded Memory Chunks"):
@@ -109,6 +147,7 @@ with st.expander("🧠 View Uploaded Memory Chunks"):
             index.remove_ids(faiss.IDSelectorRange(start_idx, start_idx + removed["num_chunks"]))
             del chunk_store[start_idx:start_idx + removed["num_chunks"]]
             del uploaded_files_meta[to_delete]
+            st.session_state.retrieval_cache.clear()
             st.experimental_rerun()
 # Upload section
 uploaded_file = st.file_uploader("Upload a document", type=["pdf", "txt"])
@@ -118,9 +157,7 @@ if uploaded_file is not None:
     if file_ext == "pdf":
         chunks = load_and_chunk_pdf(uploaded_file)
     elif file_ext == "txt":
-        text = uploaded_file.read().decode("utf-8")
-        words = text.split()
-        chunks = [" ".join(words[i:i+500]) for i in range(0, len(words), 500)]
+        chunks = chunk_words(uploaded_file.read().decode("utf-8"))
     else:
         chunks = []
 
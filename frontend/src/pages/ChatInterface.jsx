@@ -10,6 +10,30 @@ const generateSessionId = () => {
   return `session-${Date.now()}-${Math.random().toString(16).slice(2)}`;
 };
 
+// Read a text/event-stream response, calling onEvent(event, data) per event
+const readEventStream = async (response, onEvent) => {
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+    let boundary;
+    while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+      const raw = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+      let event = "message";
+      const dataLines = [];
+      for (const line of raw.split("\n")) {
+        if (line.startsWith("event:")) event = line.slice(6).trim();
+        else if (line.startsWith("data:")) dataLines.push(line.slice(5).trimStart());
+      }
+      if (dataLines.length) onEvent(event, JSON.parse(dataLines.join("\n")));
+    }
+  }
+};
+
 export default function ChatInterface() {
   const { user, logout, loading, expiryMs } = useAuth();
   const [messages, setMessages] = useState([]);
@@ -104,9 +128,10 @@ export default function ChatInterface() {
     setInput("");
     setSending(true);
 
+    let replyStarted = false;
     try {
-      // 3a) Call /api/chat for the response
-      const payload = { message: trimmed, session_id: sessionId };
+      // 3a) Call /api/chat for the response (streamed as Server-Sent Events)
+      const payload = { message: trimmed, session_id: sessionId, stream: true };
       if (selectedModel?.provider && selectedModel?.model) {
         payload.provider = selectedModel.provider;
         payload.model = selectedModel.model;
@@ -125,28 +150,51 @@ export default function ChatInterface() {
         const err = await chatRes.json();
         throw new Error(err.detail || "Chat request failed");
       }
-      const chatData = await chatRes.json();
-      const botReply = chatData.reply || "No response";
-      if (chatData.session?.provider && chatData.session?.model) {
-        const selection = {
-          provider: chatData.session.provider,
-          model: chatData.session.model,
-        };
-        setSelectedModel(selection);
-        localStorage.setItem(
-          `${MODEL_KEY_PREFIX}${sessionId}`,
-          JSON.stringify(selection)
-        );
-      }
 
-      // 3c) Append assistant's response
-      setMessages((prev) => [...prev, { role: "assistant", content: botReply }]);
+      // 3b) Show an assistant bubble right away and grow it as tokens arrive
+      const setReply = (update) =>
+        setMessages((prev) => {
+          const next = [...prev];
+          const last = next[next.length - 1];
+          next[next.length - 1] = { ...last, content: update(last.content) };
+          return next;
+        });
+      setMessages((prev) => [...prev, { role: "assistant", content: "" }]);
+      replyStarted = true;
+
+      let botReply = "";
+      await readEventStream(chatRes, (event, data) => {
+        if (event === "session" && data.session?.provider && data.session?.model) {
+          const selection = {
+            provider: data.session.provider,
+            model: data.session.model,
+          };
+          setSelectedModel(selection);
+          localStorage.setItem(
+            `${MODEL_KEY_PREFIX}${sessionId}`,
+            JSON.stringify(selection)
+          );
+        } else if (event === "delta") {
+          botReply += data;
+          setReply((content) => content + data);
+        } else if (event === "error") {
+          throw new Error(data.error || "Chat request failed");
+        }
+      });
+
+      // 3c) Finalize assistant's response
+      if (!botReply) setReply(() => "No response");
     } catch (err) {
       console.error("Send message error:", err);
-      setMessages((prev) => [
-        ...prev,
-        { role: "assistant", content: "Error: " + err.message },
-      ]);
+      const errorMessage = { role: "assistant", content: "Error: " + err.message };
+      setMessages((prev) => {
+        const last = prev[prev.length - 1];
+        // Replace the placeholder bubble if nothing was streamed into it
+        if (replyStarted && last?.role === "assistant" && !last.content) {
+          return [...prev.slice(0, -1), errorMessage];
+        }
+        return [...prev, errorMessage];
+      });
     } finally {
       setSending(false);
     }